@@ -0,0 +1,766 @@
+#!/usr/bin/python3
+
+import asyncio
+import importlib.util
+import json
+import os
+import resource
+import shlex
+import struct
+import sys
+import time
+import argparse
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+gi.require_version('GstWebRTC', '1.0')
+from gi.repository import GstWebRTC
+gi.require_version('GstSdp', '1.0')
+from gi.repository import GstSdp
+
+BENCH_VIDEO = '''videotestsrc is-live=true pattern=ball name=benchvideo !
+ video/x-raw,width=%d,height=%d,framerate=%d/1 ! timeoverlay
+'''
+BENCH_AUDIO = 'audiotestsrc is-live=true wave=red-noise'
+# A frame arriving this much later than the mean frame interval, or three
+# intervals late if that is longer, ends a freeze (as in WebRTC's stats).
+FREEZE_MARGIN = 0.15
+
+
+def script_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def load_script(name):
+    """Import one of the scripts next to this one as a module; their
+    names are not valid module names."""
+    spec = importlib.util.spec_from_file_location(
+            name[:-len('.py')].replace('-', '_'), script_path(name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def first_buffer(info):
+    if info.type & Gst.PadProbeType.BUFFER_LIST:
+        return info.get_buffer_list().get(0)
+    return info.get_buffer()
+
+
+def rtp_timestamp(buf):
+    return struct.unpack('!I', buf.extract_dup(4, 4))[0]
+
+
+def remember(mapping, key, value, limit=1000):
+    """Insert into mapping, forgetting the oldest entries past limit."""
+    mapping.setdefault(key, value)
+    while len(mapping) > limit:
+        del mapping[next(iter(mapping))]
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class LoopbackConnection:
+    """In-process stand-in for a signaling websocket."""
+    def __init__(self):
+        self.peer = None
+        self.inbox = asyncio.Queue()
+        self.closed = False
+
+    @staticmethod
+    def pair():
+        a, b = LoopbackConnection(), LoopbackConnection()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def send(self, msg):
+        if not self.peer.closed:
+            self.peer.inbox.put_nowait(msg)
+
+    async def close(self):
+        for conn in (self, self.peer):
+            if not conn.closed:
+                conn.closed = True
+                conn.inbox.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.inbox.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+
+class CaptureTimes:
+    """Wall clock capture time of every video frame the host sends.
+
+    Frames are keyed by their RTP timestamp, which survives the trip to
+    the receiver unchanged.
+    """
+    def __init__(self, media):
+        self.by_pts = {}
+        self.by_rtp = {}
+        src = media.pipe.get_by_name('benchvideo')
+        src.get_static_pad('src').add_probe(
+                Gst.PadProbeType.BUFFER, self.on_capture)
+        pay = media.pipe.get_by_name('videopay')
+        if pay is None:
+            # With --layers every session has its own payloader, and
+            # RTP timestamps, so latency is not measured.
+            return
+        pay.get_static_pad('src').add_probe(
+                Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                self.on_payloaded)
+
+    def on_capture(self, pad, info):
+        remember(self.by_pts, info.get_buffer().pts, time.monotonic())
+        return Gst.PadProbeReturn.OK
+
+    def on_payloaded(self, pad, info):
+        buf = first_buffer(info)
+        captured = self.by_pts.pop(buf.pts, None)
+        if captured is not None:
+            # Every receiver looks frames up, so they are only forgotten
+            # once they are old.
+            remember(self.by_rtp, rtp_timestamp(buf), captured)
+        return Gst.PadProbeReturn.OK
+
+
+class NetworkSimulator:
+    """Loses and delays the RTP every host webrtcbin sends.
+
+    A netsim element is put between each webrtcbin's rtpbin and its
+    transport, so what it drops is lost after retransmission and FEC
+    were set up, as on a real network.
+    """
+    def __init__(self, media, loss, delay):
+        self.loss = loss
+        self.delay = delay
+        media.pipe.connect('element-added', self.on_element_added)
+
+    def on_element_added(self, _, element):
+        factory = element.get_factory()
+        if factory is not None and factory.get_name() == 'webrtcbin':
+            element.connect('request-aux-sender', self.make_netsim)
+
+    def make_netsim(self, webrtc, transport):
+        netsim = Gst.ElementFactory.make('netsim')
+        netsim.set_property('drop-probability', self.loss / 100.0)
+        netsim.set_property('min-delay', self.delay)
+        netsim.set_property('max-delay', self.delay)
+        return netsim
+
+
+class LoopbackPeer:
+    """Browser stand-in: answers the host's offer and times what arrives.
+
+    Like a browser, it asks for a keyframe when it loses video, and
+    negotiates the host's --lossRecovery.
+    """
+    def __init__(self, conn, captures, host, media):
+        self.conn = conn
+        self.captures = captures
+        self.host = host
+        self.media = media
+        self.event_loop = asyncio.get_event_loop()
+        self.pts_to_rtp = {}
+        self.started = None
+        self.first_frame = None
+        self.last_frame = None
+        self.freezes = []
+        self.frames = 0
+        self.audio_buffers = 0
+        self.bytes = 0
+        self.latencies = []
+        self.pipe = Gst.Pipeline.new()
+        self.webrtc = Gst.ElementFactory.make('webrtcbin')
+        self.pipe.add(self.webrtc)
+        self.webrtc.connect('on-ice-candidate', self.on_ice_candidate)
+        self.webrtc.connect('pad-added', self.on_incoming_stream)
+        self.webrtc.connect('on-new-transceiver', self.on_new_transceiver)
+
+    def on_new_transceiver(self, _, transceiver):
+        # The kind may only be known once the offer is applied.
+        kind = transceiver.get_property('kind').value_nick
+        self.media.configure_transceiver(
+                transceiver, 'audio' if kind == 'audio' else 'video')
+
+    def send(self, msg):
+        """Send msg over the connection; safe to call from any thread."""
+        self.event_loop.call_soon_threadsafe(
+                asyncio.ensure_future, self.conn.send(json.dumps(msg)))
+
+    async def start(self):
+        self.pipe.set_state(Gst.State.PLAYING)
+        self.started = time.monotonic()
+        await self.conn.send(json.dumps({'ready': 'separateIce'}))
+
+    def stop(self):
+        self.pipe.set_state(Gst.State.NULL)
+
+    async def loop(self):
+        async for message in self.conn:
+            msg = json.loads(message)
+            if 'description' in msg:
+                self.on_offer(msg['description']['sdp'])
+            elif 'candidate' in msg:
+                self.webrtc.emit('add-ice-candidate', msg['sdpMLineIndex'],
+                                 msg['candidate'])
+
+    def on_offer(self, sdp):
+        res, sdpmsg = GstSdp.SDPMessage.new()
+        GstSdp.sdp_message_parse_buffer(bytes(sdp.encode()), sdpmsg)
+        offer = GstWebRTC.WebRTCSessionDescription.new(
+                GstWebRTC.WebRTCSDPType.OFFER, sdpmsg)
+        promise = Gst.Promise.new_with_change_func(self.on_offer_set, None)
+        self.webrtc.emit('set-remote-description', offer, promise)
+
+    def on_offer_set(self, promise, _):
+        promise = Gst.Promise.new_with_change_func(self.on_answer_created,
+                                                   None)
+        self.webrtc.emit('create-answer', None, promise)
+
+    def on_answer_created(self, promise, _):
+        answer = promise.get_reply().get_value('answer')
+        self.send({'description': {'type': 'answer',
+                                   'sdp': answer.sdp.as_text()}})
+        promise = Gst.Promise.new()
+        self.webrtc.emit('set-local-description', answer, promise)
+        promise.interrupt()
+
+    def on_ice_candidate(self, _, mlineindex, candidate):
+        self.send({'candidate': candidate, 'sdpMLineIndex': mlineindex})
+
+    def on_incoming_stream(self, _, pad):
+        if pad.direction != Gst.PadDirection.SRC:
+            return
+        pad.add_probe(Gst.PadProbeType.BUFFER | Gst.PadProbeType.BUFFER_LIST,
+                      self.on_rtp)
+        decodebin = Gst.ElementFactory.make('decodebin')
+        decodebin.connect('pad-added', self.on_decoded_stream)
+        decodebin.connect('deep-element-added',
+                          lambda _, __, element:
+                          self.host.request_keyframes_on_loss(element))
+        self.pipe.add(decodebin)
+        decodebin.sync_state_with_parent()
+        pad.link(decodebin.get_static_pad('sink'))
+
+    def on_decoded_stream(self, _, pad):
+        name = pad.get_current_caps().get_structure(0).get_name()
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.set_property('sync', True)
+        self.pipe.add(sink)
+        sink.sync_state_with_parent()
+        pad.link(sink.get_static_pad('sink'))
+        if name.startswith('video'):
+            sink.get_static_pad('sink').add_probe(
+                    Gst.PadProbeType.BUFFER, self.on_frame)
+        else:
+            sink.get_static_pad('sink').add_probe(
+                    Gst.PadProbeType.BUFFER, self.on_audio)
+
+    def on_rtp(self, pad, info):
+        if info.type & Gst.PadProbeType.BUFFER_LIST:
+            buffers = info.get_buffer_list()
+            buffers = [buffers.get(i) for i in range(buffers.length())]
+        else:
+            buffers = [info.get_buffer()]
+        for buf in buffers:
+            self.bytes += buf.get_size()
+        remember(self.pts_to_rtp, buffers[0].pts, rtp_timestamp(buffers[0]))
+        return Gst.PadProbeReturn.OK
+
+    def on_frame(self, pad, info):
+        now = time.monotonic()
+        if self.first_frame is None:
+            self.first_frame = now
+        elif self.frames > 1:
+            interval = (self.last_frame - self.first_frame) / (self.frames - 1)
+            gap = now - self.last_frame
+            if gap > max(3 * interval, interval + FREEZE_MARGIN):
+                self.freezes.append(gap)
+        self.last_frame = now
+        self.frames += 1
+        rtp = self.pts_to_rtp.pop(info.get_buffer().pts, None)
+        captured = self.captures.by_rtp.get(rtp)
+        if captured is not None:
+            self.latencies.append(now - captured)
+        return Gst.PadProbeReturn.OK
+
+    def on_audio(self, pad, info):
+        self.audio_buffers += 1
+        return Gst.PadProbeReturn.OK
+
+
+async def run_loopback(host, args):
+    hostArgs = ['--noQR', '--sessions', str(args.streams),
+                '--sendVideo', BENCH_VIDEO % (args.width, args.height,
+                                              args.framerate),
+                '--sendAudio', BENCH_AUDIO if args.audio else 'false']
+    hostArgs += shlex.split(args.hostArgs)
+    hargs = host.parse_args(hostArgs)
+    hargs.videoCodec = host.select_video_codec(hargs)
+    if hargs.videoCodec is None:
+        sys.exit(1)
+    media = host.MediaPipeline(hargs)
+    media.start()
+    captures = CaptureTimes(media)
+    if args.loss or args.delay:
+        if Gst.ElementFactory.find('netsim') is None:
+            sys.exit('--loss and --delay need the netsim element '
+                     '(gst-plugins-bad).')
+        NetworkSimulator(media, args.loss, args.delay)
+
+    sessions, peers, tasks = [], [], []
+    for i in range(args.streams):
+        session = host.WebRTCClient(hargs, media, 'bench-%d' % i)
+        hostConn, peerConn = LoopbackConnection.pair()
+        await session.use_connection(hostConn)
+        peer = LoopbackPeer(peerConn, captures, host, media)
+        sessions.append(session)
+        peers.append(peer)
+        tasks += [asyncio.ensure_future(session.loop()),
+                  asyncio.ensure_future(peer.loop())]
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    for peer in peers:
+        await peer.start()
+    await asyncio.sleep(args.duration)
+    ended = time.monotonic()
+    elapsed = ended - started
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (cpu.ru_utime - usage.ru_utime) + (cpu.ru_stime - usage.ru_stime)
+
+    for peer in peers:
+        await peer.conn.close()
+    await asyncio.gather(*tasks)
+    for peer in peers:
+        peer.stop()
+    media.stop()
+
+    results = []
+    for i, peer in enumerate(peers):
+        receiving = (ended - peer.first_frame
+                     if peer.first_frame is not None else 0)
+        results.append({
+            'stream': i,
+            'time_to_first_frame_ms':
+                1000 * (peer.first_frame - peer.started)
+                if peer.first_frame is not None else None,
+            'frames': peer.frames,
+            'fps': peer.frames / receiving if receiving else 0.0,
+            'bitrate_kbps': 8 * peer.bytes / elapsed / 1000,
+            'latency_ms': {
+                'p50': 1000 * percentile(peer.latencies, 50),
+                'p90': 1000 * percentile(peer.latencies, 90),
+                'p99': 1000 * percentile(peer.latencies, 99),
+                'max': 1000 * max(peer.latencies, default=float('nan')),
+            },
+            'audio_buffers': peer.audio_buffers,
+            'freezes': len(peer.freezes),
+            'freeze_ms': {
+                'mean': 1000 * sum(peer.freezes) / len(peer.freezes)
+                        if peer.freezes else 0.0,
+                'max': 1000 * max(peer.freezes, default=0.0),
+                'total': 1000 * sum(peer.freezes),
+            },
+        })
+    return {
+        'width': args.width,
+        'height': args.height,
+        'framerate': args.framerate,
+        'loss_percent': args.loss,
+        'delay_ms': args.delay,
+        'duration_s': elapsed,
+        'cpu_percent': 100 * cpu / elapsed,
+        'cpu_percent_per_stream': 100 * cpu / elapsed / args.streams,
+        'streams': results,
+    }
+
+
+async def start_signaling(connected):
+    """Serve signaling on a free local port; returns the server and its URL.
+
+    A host joining a room named in connected resolves that future with
+    the time it did.
+    """
+    import websockets
+    server_module = load_script('minimal-webrtc-server.py')
+    server = server_module.SignalingServer()
+
+    async def handler(ws, path=None):
+        if path is None:
+            path = getattr(ws, 'path', None) or ws.request.path
+        match = server_module.ROOM_PATH.search(path)
+        if match and match.group(1) == 'host':
+            future = connected.get(match.group(2))
+            if future is not None and not future.done():
+                future.set_result(time.monotonic())
+        await server.handler(ws, path)
+
+    ws_server = await websockets.serve(handler, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:%d/' % ws_server.sockets[0].getsockname()[1]
+    return ws_server, url
+
+
+async def run_startup(args):
+    connected = {}
+    ws_server, url = await start_signaling(connected)
+    times = []
+    for i in range(args.runs):
+        room = 'startup-%d' % i
+        connected[room] = asyncio.get_event_loop().create_future()
+        started = time.monotonic()
+        proc = await asyncio.create_subprocess_exec(
+                sys.executable, script_path('minimal-webrtc-host.py'),
+                '--url', url, '--roomName', room,
+                *shlex.split(args.hostArgs),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        try:
+            times.append(await asyncio.wait_for(connected[room],
+                                                args.timeout) - started)
+        except asyncio.TimeoutError:
+            print('Run %d did not connect within %.0f s.' % (i, args.timeout))
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+    ws_server.close()
+    await ws_server.wait_closed()
+    return {
+        'runs': len(times),
+        'first_ms': 1000 * times[0] if times else None,
+        'startup_ms': {
+            'min': 1000 * min(times, default=float('nan')),
+            'p50': 1000 * percentile(times, 50),
+            'max': 1000 * max(times, default=float('nan')),
+        },
+    }
+
+
+async def run_clients(host, args):
+    rooms = list(args.rooms or [])
+    url = args.url
+    ws_server, procs = None, []
+    if args.hosts:
+        # Hosts of our own, each with --sessions rooms, signaling locally.
+        connected = {}
+        ws_server, url = await start_signaling(connected)
+        for i in range(args.hosts):
+            room = 'clients-%d' % i
+            rooms.append(room)
+            for name in host_rooms(room, args.sessions):
+                connected[name] = asyncio.get_event_loop().create_future()
+            procs.append(await asyncio.create_subprocess_exec(
+                    sys.executable, script_path('minimal-webrtc-host.py'),
+                    '--url', url, '--roomName', room, '--noQR',
+                    '--sessions', str(args.sessions),
+                    *shlex.split(args.hostArgs),
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.DEVNULL))
+        try:
+            await asyncio.wait_for(asyncio.gather(*connected.values()),
+                                   args.timeout)
+        except asyncio.TimeoutError:
+            print('Not every host connected within %.0f s.' % args.timeout)
+    if not rooms or not url:
+        sys.exit('Give --url and --rooms of running hosts, or --hosts.')
+
+    clientArgs = ['--client', '--noQR', '--noReconnect', '--url', url,
+                  '--roomName', rooms[0],
+                  '--sendVideo', BENCH_VIDEO % (args.width, args.height,
+                                                args.framerate),
+                  '--sendAudio', BENCH_AUDIO if args.audio else 'false']
+    clientArgs += shlex.split(args.clientArgs)
+    cargs = host.parse_args(clientArgs)
+    cargs.videoCodec = host.select_video_codec(cargs)
+    if cargs.videoCodec is None:
+        sys.exit(1)
+    media = host.MediaPipeline(cargs)
+    media.start()
+
+    clients = [host.WebRTCClient(cargs, media, name)
+               for room in rooms for name in host_rooms(room, args.sessions)]
+    started = {}
+
+    async def connect(client):
+        started[client] = time.monotonic()
+        try:
+            await client.connect()
+        except client.connect_errors as e:
+            print('Room %s failed: %s' % (client.roomName, e))
+            return None
+        return asyncio.ensure_future(client.loop())
+
+    tasks = await asyncio.gather(*[connect(client) for client in clients])
+    await asyncio.sleep(args.duration)
+    ended = time.monotonic()
+    await asyncio.gather(*[client.update_stats(1.0) for client in clients])
+    # Hanging up clears a client's stats.
+    stats = {client: client.stats for client in clients}
+    for client in clients:
+        if client.conn is not None:
+            await client.conn.close()
+    await asyncio.gather(*[task for task in tasks if task is not None])
+    media.stop()
+    for proc in procs:
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+    if ws_server is not None:
+        ws_server.close()
+        await ws_server.wait_closed()
+
+    results = []
+    for client in clients:
+        lost = received = 0
+        for entry in host.find_stats(stats[client],
+                                     GstWebRTC.WebRTCStatsType.INBOUND_RTP,
+                                     'video'):
+            lost += max(0, entry.get('packets-lost', 0))
+            received += entry.get('packets-received', 0)
+        first = client.first_frame
+        receiving = ended - first if first is not None else 0
+        results.append({
+            'room': client.roomName,
+            'setup_ms': 1000 * (first - started[client])
+                        if first is not None else None,
+            'frames': client.frames_decoded,
+            'fps': client.frames_decoded / receiving if receiving else 0.0,
+            'packets_received': received,
+            'packets_lost': lost,
+            'loss_percent': 100.0 * lost / (lost + received)
+                            if lost + received else 0.0,
+        })
+    setups = [r['setup_ms'] for r in results if r['setup_ms'] is not None]
+    lost = sum(r['packets_lost'] for r in results)
+    received = sum(r['packets_received'] for r in results)
+    return {
+        'clients': len(results),
+        'receiving': len(setups),
+        'duration_s': args.duration,
+        'setup_ms': {
+            'p50': percentile(setups, 50),
+            'p90': percentile(setups, 90),
+            'max': max(setups, default=float('nan')),
+        },
+        'fps_min': min((r['fps'] for r in results), default=0.0),
+        'fps_mean': sum(r['fps'] for r in results) / len(results)
+                    if results else 0.0,
+        'loss_percent': 100.0 * lost / (lost + received)
+                        if lost + received else 0.0,
+        'results': results,
+    }
+
+
+def host_rooms(room, sessions):
+    """The rooms minimal-webrtc-host.py --roomName room --sessions N
+    hosts."""
+    if sessions <= 1:
+        return [room]
+    return ['%s-%d' % (room, i) for i in range(sessions)]
+
+
+def run_codecs(host, args):
+    codecs = []
+    for name, codec in host.VIDEO_CODECS.items():
+        if not host.encoder_available(codec):
+            codecs.append({'codec': name, 'available': False})
+            continue
+        speed = host.benchmark_encoder(codec, args.width, args.height,
+                                       args.framerate, args.frames)
+        codecs.append({'codec': name, 'available': True,
+                       'fps': speed and speed[0],
+                       'cpu_ms_per_frame': speed and 1000 * speed[1]})
+    return {'width': args.width, 'height': args.height,
+            'framerate': args.framerate, 'frames': args.frames,
+            'codecs': codecs}
+
+
+def print_clients(result):
+    setup = result['setup_ms']
+    print('%d of %d clients received video; setup p50 %.0f ms, p90 %.0f ms, '
+          'max %.0f ms'
+          % (result['receiving'], result['clients'], setup['p50'],
+             setup['p90'], setup['max']))
+    print('fps mean %.1f, min %.1f; packet loss %.2f%%'
+          % (result['fps_mean'], result['fps_min'], result['loss_percent']))
+    print('%-16s %8s %7s %7s %8s' % ('room', 'setup ms', 'frames', 'fps',
+                                     'loss %'))
+    for r in result['results']:
+        print('%-16s %8s %7d %7.1f %8.2f'
+              % (r['room'],
+                 '-' if r['setup_ms'] is None else '%.0f' % r['setup_ms'],
+                 r['frames'], r['fps'], r['loss_percent']))
+
+
+def print_codecs(result):
+    print('%d frames at %dx%d, realtime is %d fps'
+          % (result['frames'], result['width'], result['height'],
+             result['framerate']))
+    print('%-9s %7s %12s' % ('codec', 'fps', 'CPU ms/frame'))
+    for codec in result['codecs']:
+        if not codec['available']:
+            print('%-9s %7s' % (codec['codec'], 'missing'))
+        elif codec['fps'] is None:
+            print('%-9s %7s' % (codec['codec'], 'failed'))
+        else:
+            print('%-9s %7.0f %12.2f' % (codec['codec'], codec['fps'],
+                                         codec['cpu_ms_per_frame']))
+
+
+def print_startup(result):
+    if not result['runs']:
+        print('No run connected.')
+        return
+    startup = result['startup_ms']
+    print('Launch to signaling connected over %d runs: first %.0f ms, '
+          'min %.0f ms, median %.0f ms, max %.0f ms'
+          % (result['runs'], result['first_ms'], startup['min'],
+             startup['p50'], startup['max']))
+
+
+def print_loopback(result):
+    print('%dx%d@%d for %.1f s, CPU %.1f%% (%.1f%% per stream)'
+          % (result['width'], result['height'], result['framerate'],
+             result['duration_s'], result['cpu_percent'],
+             result['cpu_percent_per_stream']))
+    if result['loss_percent'] or result['delay_ms']:
+        print('Network: %.1f%% loss, %d ms delay'
+              % (result['loss_percent'], result['delay_ms']))
+    print('%6s %8s %7s %9s %8s %8s %8s %8s %7s %9s'
+          % ('stream', 'ttff ms', 'fps', 'kbit/s',
+             'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'freezes',
+             'freeze ms'))
+    for stream in result['streams']:
+        latency = stream['latency_ms']
+        ttff = stream['time_to_first_frame_ms']
+        print('%6d %8s %7.1f %9.0f %8.1f %8.1f %8.1f %8.1f %7d %9.0f'
+              % (stream['stream'],
+                 '-' if ttff is None else '%.0f' % ttff,
+                 stream['fps'], stream['bitrate_kbps'],
+                 latency['p50'], latency['p90'], latency['p99'],
+                 latency['max'], stream['freezes'],
+                 stream['freeze_ms']['mean']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Benchmark minimal-webrtc-host.py offline.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    loopback = subparsers.add_parser(
+            'loopback', help='stream to in-process receivers over loopback '
+                             + 'and measure glass-to-glass latency')
+    loopback.add_argument('--duration', type=float, default=10,
+                          help='seconds to measure for')
+    loopback.add_argument('--width', type=int, default=1280)
+    loopback.add_argument('--height', type=int, default=720)
+    loopback.add_argument('--framerate', type=int, default=30)
+    loopback.add_argument('--streams', type=int, default=1,
+                          help='number of receivers')
+    loopback.add_argument('--audio', action='store_true',
+                          help='also send test audio')
+    loopback.add_argument('--loss', type=float, default=0,
+                          help='percentage of the host\'s RTP packets to '
+                               + 'drop, to compare --lossRecovery settings')
+    loopback.add_argument('--delay', type=int, default=0,
+                          help='ms to delay the host\'s RTP packets by')
+    loopback.add_argument('--hostArgs', default='',
+                          help='extra minimal-webrtc-host.py arguments')
+    loopback.add_argument('--json', action='store_true',
+                          help='print the results as JSON')
+    startup = subparsers.add_parser(
+            'startup', help='time launching minimal-webrtc-host.py until '
+                            + 'it is connected to a local signaling server')
+    startup.add_argument('--runs', type=int, default=10,
+                         help='number of launches')
+    startup.add_argument('--timeout', type=float, default=30,
+                         help='seconds to wait for each launch')
+    startup.add_argument('--hostArgs', default='',
+                         help='extra minimal-webrtc-host.py arguments')
+    startup.add_argument('--json', action='store_true',
+                         help='print the results as JSON')
+    codecs = subparsers.add_parser(
+            'codecs', help='measure how fast each video encoder the host '
+                           + 'supports runs on this CPU')
+    codecs.add_argument('--width', type=int, default=1280)
+    codecs.add_argument('--height', type=int, default=720)
+    codecs.add_argument('--framerate', type=int, default=30)
+    codecs.add_argument('--frames', type=int, default=150,
+                        help='number of frames to encode')
+    codecs.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    clients = subparsers.add_parser(
+            'clients', help='connect many headless clients to hosts and '
+                            + 'measure setup time, frame rate and loss')
+    clients.add_argument('--url',
+                         help='signaling URL of the hosts, as their --url')
+    clients.add_argument('--rooms', nargs='+', metavar='ROOM',
+                         help='--roomName of each host to join')
+    clients.add_argument('--hosts', type=int, default=0,
+                         help='start this many hosts, and a signaling '
+                              + 'server for them, instead')
+    clients.add_argument('--sessions', type=int, default=1,
+                         help='rooms per host, as the hosts\' --sessions; '
+                              + 'one client joins each')
+    clients.add_argument('--duration', type=float, default=10,
+                         help='seconds to measure for')
+    clients.add_argument('--timeout', type=float, default=30,
+                         help='seconds to wait for --hosts to connect')
+    clients.add_argument('--width', type=int, default=640)
+    clients.add_argument('--height', type=int, default=480)
+    clients.add_argument('--framerate', type=int, default=30)
+    clients.add_argument('--audio', action='store_true',
+                         help='also send test audio')
+    clients.add_argument('--hostArgs', default='',
+                         help='extra minimal-webrtc-host.py arguments for '
+                              + '--hosts')
+    clients.add_argument('--clientArgs', default='',
+                         help='extra minimal-webrtc-host.py --client '
+                              + 'arguments')
+    clients.add_argument('--json', action='store_true',
+                         help='print the results as JSON')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    if args.command == 'loopback':
+        Gst.init(None)
+        host = load_script('minimal-webrtc-host.py')
+        if not host.check_plugins():
+            sys.exit(1)
+        result = loop.run_until_complete(run_loopback(host, args))
+        printer = print_loopback
+    elif args.command == 'clients':
+        Gst.init(None)
+        host = load_script('minimal-webrtc-host.py')
+        if not host.check_plugins():
+            sys.exit(1)
+        load_script('minimal-webrtc-server.py').raise_file_limit()
+        result = loop.run_until_complete(run_clients(host, args))
+        printer = print_clients
+    elif args.command == 'codecs':
+        Gst.init(None)
+        host = load_script('minimal-webrtc-host.py')
+        result = run_codecs(host, args)
+        printer = print_codecs
+    else:
+        result = loop.run_until_complete(run_startup(args))
+        printer = print_startup
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        printer(result)
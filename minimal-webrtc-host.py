@@ -3,60 +3,257 @@
 import random
 import ssl
 import string
-import websockets
 import asyncio
+import functools
+import glob
+import importlib
 import os
+import signal
 import sys
 import json
 import argparse
-
-import qrcode
+import time
+import threading
 
 import gi
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst
-gi.require_version('GstWebRTC', '1.0')
-from gi.repository import GstWebRTC
-gi.require_version('GstSdp', '1.0')
-from gi.repository import GstSdp
-
-PIPELINE_START = 'webrtcbin name=sendrecv\n'
-PIPELINE_VIDEO_POSTFIX = ''' ! videoconvert ! queue !
- vp8enc deadline=1 ! rtpvp8pay !
- queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 !
- sendrecv.
+from gi.repository import GLib, Gst
+
+NEEDED_PLUGINS = ["opus", "nice", "webrtc", "dtls", "srtp", "rtp",
+                  "rtpmanager", "videotestsrc", "audiotestsrc"]
+RECORD_PLUGINS = ["matroska", "multifile"]
+CACHE_DIR = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'minimal-webrtc-gstreamer')
+CODEC_CACHE = os.path.join(CACHE_DIR, 'codecs.json')
+
+# Video encoders --videoCodec can choose from: the encoder with its
+# options, caps to force after it, the payloader, the RTP encoding-name,
+# the encoder's bitrate property with its unit in bit/s and the options
+# --lossRecovery adds (error resilience, keyframes at least every 5 s).
+VIDEO_CODECS = {
+    'vp8': {'encoder': 'vp8enc deadline=1',
+            'pay': 'rtpvp8pay', 'encoding': 'VP8',
+            'bitrate': ('target-bitrate', 1),
+            'resilient': 'error-resilient=default+partitions '
+                         'keyframe-max-dist=150'},
+    'vp9': {'encoder': 'vp9enc deadline=1 cpu-used=8 row-mt=true',
+            'pay': 'rtpvp9pay', 'encoding': 'VP9',
+            'bitrate': ('target-bitrate', 1),
+            'resilient': 'error-resilient=default keyframe-max-dist=150'},
+    'h264': {'encoder': 'x264enc tune=zerolatency speed-preset=ultrafast',
+             # What every browser decodes, in hardware on most phones.
+             'caps': 'video/x-h264,profile=constrained-baseline',
+             'pay': 'rtph264pay config-interval=-1', 'encoding': 'H264',
+             'bitrate': ('bitrate', 1000),
+             'resilient': 'key-int-max=150'},
+    'openh264': {'encoder': 'openh264enc complexity=low',
+                 'caps': 'video/x-h264,profile=constrained-baseline',
+                 'pay': 'rtph264pay config-interval=-1', 'encoding': 'H264',
+                 'bitrate': ('bitrate', 1),
+                 'resilient': 'gop-size=150'},
+    'av1': {'encoder': 'av1enc usage-profile=realtime cpu-used=8',
+            'pay': 'rtpav1pay', 'encoding': 'AV1',
+            'bitrate': ('target-bitrate', 1000),
+            'resilient': 'keyframe-max-dist=150'},
+}
+# Every WebRTC browser has to decode these.
+AUTO_CODECS = 'vp8,h264,openh264'
+
+# Seconds between keyframes forced for the peers' PLI/FIR requests, which
+# are merged in between, and between the keyframes a decoder asks for
+# with --lossRecovery.
+KEYFRAME_MIN_INTERVAL = 0.25
+# Seconds a --layers switch drops delta frames waiting for the keyframe
+# it asked for, on top of KEYFRAME_MIN_INTERVAL, before it gives up and
+# shows them anyway.
+KEYFRAME_WAIT = 1.0
+# Share of video bandwidth spent on ULPFEC with --lossRecovery fec.
+FEC_PERCENTAGE = 20
+
+# What --latencyProfile sets: queue limits (leaky ones drop the oldest
+# data instead of letting it wait, which only queues of raw media do),
+# webrtcbin's jitterbuffer latency in ms, encoder options by
+# --videoCodec, the Opus frame size in ms, sync on received video and
+# the audio sinks' buffer-time and latency-time in us.
+LATENCY_PROFILES = {
+    'ultra-low-latency': {
+        'queue': {'max-size-buffers': 0, 'max-size-bytes': 0,
+                  'max-size-time': 40 * Gst.MSECOND, 'leaky': 'downstream'},
+        'latency': 20,
+        'encoder': {
+            'vp8': 'cpu-used=16 lag-in-frames=0 end-usage=cbr '
+                   'threads={threads}',
+            'vp9': 'cpu-used=8 lag-in-frames=0 end-usage=cbr '
+                   'threads={threads}',
+            'h264': 'speed-preset=ultrafast tune=zerolatency '
+                    'sliced-threads=true threads={threads}',
+            'openh264': 'complexity=low multi-thread={threads}',
+            'av1': 'cpu-used=8 lag-in-frames=0 threads={threads}',
+        },
+        'opus-frame-size': '10',
+        'sync': False,
+        'audio-buffer': (40000, 10000),
+    },
+    'balanced': {
+        'queue': {'max-size-buffers': 0, 'max-size-bytes': 0,
+                  'max-size-time': 150 * Gst.MSECOND, 'leaky': 'downstream'},
+        'latency': 100,
+        'encoder': {
+            'vp8': 'cpu-used=8 lag-in-frames=0 threads={threads}',
+            'vp9': 'cpu-used=7 lag-in-frames=0 threads={threads}',
+            'h264': 'speed-preset=superfast tune=zerolatency '
+                    'threads={threads}',
+            'openh264': 'complexity=medium multi-thread={threads}',
+            'av1': 'cpu-used=7 lag-in-frames=0 threads={threads}',
+        },
+        'opus-frame-size': '20',
+        'sync': True,
+        'audio-buffer': (100000, 10000),
+    },
+    'quality': {
+        'queue': {},
+        'latency': 200,
+        'encoder': {
+            'vp8': 'cpu-used=4 threads={threads}',
+            'vp9': 'cpu-used=5 threads={threads}',
+            'h264': 'speed-preset=veryfast tune=zerolatency '
+                    'threads={threads}',
+            'openh264': 'complexity=high multi-thread={threads}',
+            'av1': 'cpu-used=6 threads={threads}',
+        },
+        'sync': True,
+    },
+}
+
+PIPELINE_VIDEO_SCALER = ''' ! {scale} ! videorate !
+ capsfilter name=videocaps caps=video/x-raw'''
+PIPELINE_VIDEO_POSTFIX = ''' ! {convert} ! queue !
+ {encoder} name=videoenc{caps} ! {pay} name=videopay !
+ queue ! application/x-rtp,media=video,encoding-name={encoding},payload=97 !
+ tee name=videotee allow-not-linked=true
 '''
-PIPELINE_AUDIO_POSTFIX = ''' ! audioconvert ! audioresample ! queue !
+PIPELINE_AUDIO_POSTFIX = ''' ! {convert} ! queue !
  opusenc ! rtpopuspay !
  queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 !
- sendrecv.
+ tee name=audiotee allow-not-linked=true
+'''
+# One encoding of --layers, each scaled from the shared capture.
+PIPELINE_VIDEO_LAYER = ''' layers. ! queue ! {scale} ! {convert} !
+ video/x-raw,width={width},height={height} ! queue !
+ {encoder} name=videoenc-{index} {bitrate}{caps} !
+ tee name=videotee-{index} allow-not-linked=true
 '''
 
+# Elements that only convert raw media, and are reported by
+# MediaPipeline.watch_conversions(); and the number of frames a
+# conversion is timed over.
+CONVERTERS = ('videoconvert', 'videoscale', 'audioconvert', 'audioresample')
+CONVERSION_FRAMES = 100
 
-class WebRTCClient:
+# With --relay the tees are fed from what the source peer sends.
+PIPELINE_VIDEO_RELAY = '''rtpvp8pay name=videopay !
+ queue ! application/x-rtp,media=video,encoding-name=VP8,payload=97 !
+ tee name=videotee allow-not-linked=true
+'''
+PIPELINE_AUDIO_RELAY = '''rtpopuspay name=audiopay !
+ queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 !
+ tee name=audiotee allow-not-linked=true
+'''
+# What the relay source is asked to send, matching the payloaders above.
+RELAY_CAPS = {
+    'video': 'application/x-rtp,media=video,encoding-name=VP8,payload=97,'
+             'clock-rate=90000,rtcp-fb-nack-pli=(boolean)true',
+    'audio': 'application/x-rtp,media=audio,encoding-name=OPUS,payload=96,'
+             'clock-rate=48000',
+}
+
+# Output caps used by --adaptResolution, best first, each with the lowest
+# target bitrate (in bit/s) it is used at.
+RESOLUTION_LADDER = [
+    (1200000, 'video/x-raw'),
+    (500000, 'video/x-raw,width=640,height=360,framerate=30/1'),
+    (200000, 'video/x-raw,width=480,height=270,framerate=20/1'),
+    (0, 'video/x-raw,width=320,height=180,framerate=15/1'),
+]
+
+
+def import_gi(name):
+    """Import gi.repository.<name> the first time it is needed.
+
+    Loading a typelib takes time at startup, and GstSdp, for example,
+    is not needed until the first answer arrives.
+    """
+    gi.require_version(name, '1.0')
+    return importlib.import_module('gi.repository.' + name)
+
+
+def stats_to_dict(reply):
+    """Convert a webrtcbin get-stats reply into {id: {field: value}}."""
+    stats = {}
+    for i in range(reply.n_fields()):
+        name = reply.nth_field_name(i)
+        entry = reply.get_value(name)
+        if not isinstance(entry, Gst.Structure):
+            continue
+        stats[name] = {entry.nth_field_name(j):
+                       entry.get_value(entry.nth_field_name(j))
+                       for j in range(entry.n_fields())}
+    return stats
+
+
+def stats_kind(stats, entry):
+    """Return 'audio' or 'video' for an RTP stats entry, if known."""
+    if 'kind' in entry:
+        return entry['kind']
+    if 'local-id' in entry:
+        return stats_kind(stats, stats.get(entry['local-id'], {}))
+    codec = stats.get(entry.get('codec-id'), {})
+    return (codec.get('mime-type') or '').split('/')[0].lower() or None
+
+
+def find_stats(stats, stats_type, kind=None):
+    """Return the entries of stats_type, optionally only for kind media."""
+    return [entry for entry in stats.values()
+            if entry.get('type') == stats_type
+            and (kind is None or stats_kind(stats, entry) == kind)]
+
+
+class MediaPipeline:
+    """Capture and encode chains shared by every hosted session.
+
+    Each chain ends in a tee; a session attaches its own webrtcbin behind
+    a queue and a valve on each tee, so an extra viewer costs a copy of
+    the payloaded stream instead of another encoder.
+    """
     def __init__(self, args):
-        self.conn = None
-        self.pipe = None
-        self.webrtc = None
-        self.url = args.url
-        self.has_offer = False
-        self.is_host = True
         self.args = args
-
-        if args.roomName is None:
-            # From https://stackoverflow.com/a/2030081
-            self.roomName = ''.join(random.choice(string.ascii_lowercase)
-                                    for i in range(6))
-        else:
-            self.roomName = args.roomName
-        qr = qrcode.QRCode()
-        client_url = '#'.join([self.url, self.roomName])
-        print(client_url)
-        qr.add_data(client_url)
-        qr.print_ascii(tty=True)
-        self.server = 'ws' + self.url[4:] + 'ws/'\
-            + ('host' if self.is_host else 'client') + '/'\
-            + self.roomName + '/'
+        self.pipe = None
+        self.bus = None
+        self.loop = None
+        self.tees = {}
+        self.layer_tees = []
+        self.selectors = {}
+        self.valves = {}
+        self.channels = {}
+        self.sink_templates = {}
+        self.attached = 0
+        self.warm = []
+        self.sessions = []
+        self.stats_listeners = []
+        self.encoder = None
+        self.codec = VIDEO_CODECS.get(args.videoCodec)
+        self.profile = LATENCY_PROFILES.get(args.latencyProfile, {})
+        self.latency = None
+        self.videocaps = None
+        self.queues = []
+        self.shared = []
+        self.closing = {}
+        self.stopping = False
+        self.status = 0
+        self.qos = {}
+        self.keyframes = {}
+        self.keyframes_pending = set()
 
         falseStrings = ['false', 'null', 'none', 'no']
         testStrings = ['test']
@@ -78,6 +275,8 @@ class WebRTCClient:
         elif videoPipeline.lower() in testStrings:
             self.sendVideo = True
             videoPipeline = 'videotestsrc pattern=ball'
+        else:
+            self.sendVideo = True
 
         enableAudio = self.sendAudio or self.args.receiveAudio
         enableVideo = self.sendVideo or self.args.receiveVideo != 'false'
@@ -86,51 +285,1936 @@ class WebRTCClient:
             print('Must enable audio or video.')
             sys.exit()
 
-        self.pipeline = PIPELINE_START
+        self.pipeline = ''
         if enableAudio:
-            self.pipeline += audioPipeline + PIPELINE_AUDIO_POSTFIX
+            self.pipeline += audioPipeline + PIPELINE_AUDIO_POSTFIX.format(
+                    convert=self.conversion(audioPipeline, 'opusenc',
+                                            ['audioconvert',
+                                             'audioresample'], None))
+        encoder = None
+        if self.codec is not None:
+            options = self.profile.get('encoder', {}).get(args.videoCodec)
+            encoder = self.codec['encoder']
+            if options:
+                encoder += ' ' + options.format(
+                        threads=min(os.cpu_count() or 1, 8))
+            if args.lossRecovery:
+                encoder += ' ' + self.codec['resilient']
+        if self.codec is None:
+            # With --relay nothing is encoded; see below.
+            enableVideo = False
         if enableVideo:
-            self.pipeline += videoPipeline + PIPELINE_VIDEO_POSTFIX
+            # Scalers may sit between the two, so only the format is
+            # fixed, never the size or rate.
+            convert = self.conversion(videoPipeline, encoder.split()[0],
+                                      ['videoconvert'], ['format'])
+        if enableVideo and self.args.layers:
+            self.pipeline += videoPipeline + ' ! tee name=layers\n'
+            prop, unit = self.codec['bitrate']
+            for index, (width, height, kbps) in enumerate(self.args.layers):
+                self.pipeline += PIPELINE_VIDEO_LAYER.format(
+                        index=index, width=width, height=height,
+                        scale=converter('videoscale'), convert=convert,
+                        encoder=encoder,
+                        bitrate='%s=%d' % (prop, kbps * 1000 // unit),
+                        caps=' ! ' + self.codec['caps']
+                        if 'caps' in self.codec else '')
+        elif enableVideo:
+            self.pipeline += videoPipeline
+            if self.args.adaptResolution:
+                self.pipeline += PIPELINE_VIDEO_SCALER.format(
+                        scale=converter('videoscale'))
+            self.pipeline += PIPELINE_VIDEO_POSTFIX.format(
+                    convert=convert, encoder=encoder,
+                    caps=' ! ' + self.codec['caps']
+                    if 'caps' in self.codec else '',
+                    pay=self.codec['pay'], encoding=self.codec['encoding'])
+
+        if self.args.relay:
+            # Nothing is captured or encoded; see relay_from().
+            self.sendAudio = bool(self.args.receiveAudio)
+            self.sendVideo = self.args.receiveVideo not in (False, 'false')
+            self.pipeline = ''
+            if self.sendAudio:
+                self.pipeline += PIPELINE_AUDIO_RELAY
+            if self.sendVideo:
+                self.pipeline += PIPELINE_VIDEO_RELAY
+            if not self.pipeline:
+                print('Must receive audio or video to relay.')
+                sys.exit()
+
+    def start(self):
+        print('In MediaPipeline.start...')
+        self.loop = asyncio.get_event_loop()
+        self.pipe = Gst.parse_launch(self.pipeline)
+        for media in ('audio', 'video'):
+            tee = self.pipe.get_by_name(media + 'tee')
+            if tee is not None:
+                self.tees[media] = tee
+        for index in range(len(self.args.layers or [])):
+            tee = self.pipe.get_by_name('videotee-%d' % index)
+            if tee is not None:
+                self.layer_tees.append(tee)
+        self.encoder = self.pipe.get_by_name('videoenc')
+        self.videocaps = self.pipe.get_by_name('videocaps')
+        # Everything parsed up front is the capture and encoding chain all
+        # sessions share; attach() adds what is theirs alone.
+        self.shared = list(self.pipe.iterate_elements())
+        self.queues = [element for element in self.pipe.iterate_elements()
+                       if element.get_factory().get_name() == 'queue']
+        for q in self.queues:
+            self.configure_queue(q, carries_raw(q))
+        self.watch_conversions(self.pipe)
+        if self.profile.get('opus-frame-size'):
+            for element in self.pipe.iterate_elements():
+                if element.get_factory().get_name() == 'opusenc':
+                    Gst.util_set_object_arg(element, 'frame-size',
+                                            self.profile['opus-frame-size'])
+        # The bus signals pending messages on a file descriptor, so the
+        # asyncio loop that runs the websockets can wait on it directly
+        # instead of needing a GLib main loop.
+        self.bus = self.pipe.get_bus()
+        self.loop.add_reader(self.bus.get_pollfd().fd, self.on_bus_readable)
+        for kind, spec in (('video', self.args.receiveVideoTo),
+                           ('audio', self.args.receiveAudioTo)):
+            if spec in (None, 'none'):
+                continue
+            description, mode = receive_sink(kind, spec, self.args,
+                                             self.profile)
+            try:
+                self.sink_templates[kind] = SinkTemplate(
+                        kind, spec, description, mode, self.loop,
+                        None if mode else self.tune_branch)
+            except GLib.Error as e:
+                print('Cannot receive %s to %s: %s' % (kind, spec, e.message))
+                sys.exit(1)
+        self.pipe.set_state(Gst.State.PLAYING)
+        self.prewarm()
+
+    def conversion(self, source, encoder, converters, fields):
+        """What to put between source and encoder (gst-launch).
+
+        If source can produce a format encoder takes, that is a
+        capsfilter asking for it, restricted to fields (with their caps
+        features) unless fields is None, and nothing is converted;
+        otherwise the converters, with as many threads as they can use.
+        """
+        fallback = ' ! '.join(converter(name) for name in converters)
+        if self.args.relay:
+            # Nothing is captured; see relay_from().
+            return fallback
+        try:
+            caps = ready_caps(Gst.parse_bin_from_description(source, True),
+                              'src')
+        except GLib.Error:
+            caps = None
+        factory = Gst.ElementFactory.find(encoder)
+        if caps is not None and factory is not None:
+            for template in factory.get_static_pad_templates():
+                if template.direction != Gst.PadDirection.SINK:
+                    continue
+                common = caps.intersect(template.get_caps())
+                if common.is_empty():
+                    continue
+                if fields is not None:
+                    common = only_fields(common, fields)
+                print('%s takes what %s produces; not converting.'
+                      % (encoder, source.split()[0]))
+                return 'capsfilter caps="%s"' % common.to_string()
+        print('Converting for %s with %s.' % (encoder, fallback))
+        return fallback
+
+    def watch_conversions(self, bin):
+        """Report what every converter in bin does once its caps are
+        set, and what that costs per frame."""
+        for element in bin.iterate_recurse():
+            factory = element.get_factory()
+            if factory is not None and factory.get_name() in CONVERTERS:
+                element.get_static_pad('src').connect(
+                        'notify::caps', self.on_conversion_caps, element)
+
+    def on_conversion_caps(self, pad, _, element):
+        srccaps = pad.get_current_caps()
+        sinkcaps = element.get_static_pad('sink').get_current_caps()
+        if srccaps is None or sinkcaps is None:
+            return
+        name = element.get_name()
+        if sinkcaps.is_equal(srccaps):
+            print('%s passes %s through unconverted.'
+                  % (name, describe_caps(sinkcaps)))
+            return
+        description = '%s -> %s' % (describe_caps(sinkcaps),
+                                    describe_caps(srccaps))
+        timing = {'entered': {}, 'frames': 0, 'total': 0.0}
+        element.get_static_pad('sink').add_probe(
+                Gst.PadProbeType.BUFFER, self.on_conversion_input, timing)
+        pad.add_probe(Gst.PadProbeType.BUFFER, self.on_conversion_output,
+                      name, description, timing)
+
+    def on_conversion_input(self, pad, info, timing):
+        if timing['frames'] >= CONVERSION_FRAMES:
+            return Gst.PadProbeReturn.REMOVE
+        timing['entered'][info.get_buffer().pts] = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    def on_conversion_output(self, pad, info, name, description, timing):
+        entered = timing['entered'].pop(info.get_buffer().pts, None)
+        if entered is None:
+            return Gst.PadProbeReturn.OK
+        timing['frames'] += 1
+        timing['total'] += time.monotonic() - entered
+        if timing['frames'] < CONVERSION_FRAMES:
+            return Gst.PadProbeReturn.OK
+        print('%s converts %s: %.2f ms per frame'
+              % (name, description, 1000 * timing['total'] / timing['frames']))
+        return Gst.PadProbeReturn.REMOVE
+
+    def configure_queue(self, q, raw):
+        """Apply --latencyProfile's limits to q.
+
+        Only a queue of raw media may leak: an encoded frame or RTP packet
+        dropped there corrupts video until the next keyframe, and
+        webrtcbin could not even retransmit it.
+        """
+        for name, value in self.profile.get('queue', {}).items():
+            if name != 'leaky' or raw:
+                Gst.util_set_object_arg(q, name, str(value))
+
+    def configure_sink(self, sink, kind):
+        """Apply --latencyProfile to a sink of received media."""
+        if not self.profile:
+            return
+        if isinstance(sink, Gst.Bin):
+            # An auto*sink; configure the sink it picks.
+            sink.connect('deep-element-added', self.on_auto_sink_element,
+                         kind)
+            return
+        if kind == 'video' and sink.find_property('sync') is not None:
+            sink.set_property('sync', self.profile['sync'])
+        if kind == 'audio' and 'audio-buffer' in self.profile \
+                and sink.find_property('buffer-time') is not None:
+            buffer_time, latency_time = self.profile['audio-buffer']
+            sink.set_property('buffer-time', buffer_time)
+            sink.set_property('latency-time', latency_time)
+
+    def tune_branch(self, branch, kind):
+        """Apply --latencyProfile to the queues and sinks of a bin."""
+        for element in branch.iterate_recurse():
+            factory = element.get_factory()
+            if factory is not None and factory.get_name() == 'queue':
+                self.configure_queue(element, True)
+            elif element.get_name() == 'sink':
+                self.configure_sink(element, kind)
+
+    def on_auto_sink_element(self, _, __, element, kind):
+        if not isinstance(element, Gst.Bin):
+            self.configure_sink(element, kind)
+
+    def report_latency(self):
+        query = Gst.Query.new_latency()
+        if not self.pipe.query(query):
+            return
+        live, minimum, _ = query.parse_latency()
+        if live and minimum != self.latency:
+            self.latency = minimum
+            print('Pipeline latency is now %.1f ms' % (minimum / 1e6))
+
+    def prewarm(self):
+        while len(self.warm) < self.args.prewarm:
+            self.warm.append(WarmWebRTC(self))
+
+    def take_warm(self):
+        """Return a pre-warmed webrtcbin, if any, and start replacing it."""
+        if not self.warm:
+            return None
+        self.loop.call_soon(self.prewarm)
+        return self.warm.pop(0)
+
+    def stop(self):
+        print('In MediaPipeline.stop...')
+        if self.bus is not None:
+            self.loop.remove_reader(self.bus.get_pollfd().fd)
+            self.bus = None
+        if self.pipe is not None:
+            self.pipe.set_state(Gst.State.NULL)
+
+    def shutdown(self, status):
+        """Stop serving: close every session's websocket."""
+        self.status = max(self.status, status)
+        self.stopping = True
+        for session in self.sessions:
+            if session.conn is not None:
+                asyncio.ensure_future(session.conn.close())
+
+    def top_level(self, element):
+        """The child of the pipeline element is or is inside of.
+
+        That is the pipeline itself for its own messages and None for an
+        element already removed from it.
+        """
+        while element is not None and element is not self.pipe:
+            parent = element.get_parent()
+            if parent is self.pipe:
+                return element
+            element = parent
+        return element
+
+    def session_of(self, element):
+        """The session that attached element to the pipeline, if any."""
+        for session in self.sessions:
+            selector = self.selectors.get(session.webrtc)
+            owned = ([session.webrtc] + [q for _, _, q in session.branches]
+                     + session.elements
+                     + (selector.elements if selector else [])
+                     + self.valves.get(session.webrtc, []))
+            if element in owned:
+                return session
+        return None
+
+    def on_bus_readable(self):
+        while self.bus is not None:
+            message = self.bus.pop()
+            if message is None:
+                break
+            self.on_bus_message(message)
+
+    def on_bus_message(self, message):
+        t = message.type
+        if t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            print('Error from %s: %s\n%s'
+                  % (message.src.get_name(), err.message, debug))
+            child = self.top_level(message.src)
+            if child is self.pipe or child in self.shared:
+                self.shutdown(1)
+            elif child is not None:
+                session = self.session_of(child)
+                if session is not None:
+                    print('Stopping the session in room %s.'
+                          % session.roomName)
+                    session.stop_pipeline()
+        elif t == Gst.MessageType.WARNING:
+            err, debug = message.parse_warning()
+            print('Warning from %s: %s\n%s'
+                  % (message.src.get_name(), err.message, debug))
+        elif t == Gst.MessageType.EOS:
+            print('End of stream.')
+            self.shutdown(0)
+        elif t == Gst.MessageType.LATENCY:
+            self.pipe.recalculate_latency()
+            self.report_latency()
+        elif t == Gst.MessageType.QOS:
+            fmt, processed, dropped = message.parse_qos_stats()
+            name = message.src.get_name()
+            if dropped > self.qos.get(name, 0):
+                print('QoS: %s dropped %d of %d buffers'
+                      % (name, dropped, processed + dropped))
+            self.qos[name] = dropped
+        elif t == Gst.MessageType.STATE_CHANGED:
+            if message.src == self.pipe:
+                old, new, pending = message.parse_state_changed()
+                print('Pipeline state %s -> %s'
+                      % (Gst.Element.state_get_name(old),
+                         Gst.Element.state_get_name(new)))
+        elif t == Gst.MessageType.ELEMENT:
+            s = message.get_structure()
+            if s is not None:
+                print('Element message from %s: %s'
+                      % (message.src.get_name(), s.to_string()))
+                if s.get_name() == 'splitmuxsink-fragment-closed':
+                    self.recording_closed(message.src)
+
+    def set_video_bitrate(self, bitrate):
+        if self.encoder is not None:
+            prop, unit = self.codec['bitrate']
+            self.encoder.set_property(prop, bitrate // unit)
+
+    def set_video_caps(self, caps):
+        if self.videocaps is not None:
+            self.videocaps.set_property('caps', Gst.Caps.from_string(caps))
+
+    async def stats_loop(self, interval):
+        """Refresh every session's stats, then call stats_listeners."""
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.gather(*[session.update_stats(interval)
+                                   for session in self.sessions])
+            for listener in self.stats_listeners:
+                listener()
+
+    def request_keyframe(self, tee=None):
+        """Ask the encoder feeding tee for a keyframe; return whether
+        anything upstream took the request."""
+        tee = tee or self.tees.get('video')
+        if tee is None:
+            return False
+        s = Gst.Structure.new_from_string(
+                'GstForceKeyUnit, all-headers=(boolean)true')
+        event = Gst.Event.new_custom(Gst.EventType.CUSTOM_UPSTREAM, s)
+        # An upstream event is pushed from a sink pad to its peer;
+        # send_event() would refuse it there as going the wrong way.
+        if not tee.get_static_pad('sink').push_event(event):
+            print('Nothing upstream of %s forced a keyframe.'
+                  % tee.get_name())
+            return False
+        self.keyframes[tee] = time.monotonic()
+        return True
+
+    def on_keyframe_request(self, pad, info, tee):
+        """Take a session's keyframe request (its peer's PLI or FIR) from
+        webrtcbin and force the keyframe from the asyncio loop."""
+        s = info.get_event().get_structure()
+        if s is None or s.get_name() != 'GstForceKeyUnit':
+            return Gst.PadProbeReturn.OK
+        self.loop.call_soon_threadsafe(self.keyframe_requested, tee)
+        return Gst.PadProbeReturn.DROP
+
+    def keyframe_requested(self, tee):
+        """Force a keyframe right away, unless one was just forced.
+
+        Every session fed from tee shares its encoder, so the requests of
+        all of them within KEYFRAME_MIN_INTERVAL get a single keyframe.
+        """
+        if tee in self.keyframes_pending:
+            return
+        wait = (self.keyframes.get(tee, 0) + KEYFRAME_MIN_INTERVAL
+                - time.monotonic())
+        if wait <= 0:
+            self.request_keyframe(tee)
+            return
+        self.keyframes_pending.add(tee)
+
+        def request():
+            self.keyframes_pending.discard(tee)
+            self.request_keyframe(tee)
+        self.loop.call_later(wait, request)
+
+    def configure_transceiver(self, transceiver, kind):
+        """Apply --lossRecovery to a transceiver sending or receiving kind.
+
+        Only video gets retransmissions and FEC: a lost audio packet is
+        concealed before it could be repaired.
+        """
+        if not self.args.lossRecovery or kind != 'video':
+            return
+        transceiver.set_property('do-nack', True)
+        if self.args.lossRecovery == 'fec':
+            GstWebRTC = import_gi('GstWebRTC')
+            transceiver.set_property('fec-type',
+                                     GstWebRTC.WebRTCFECType.ULP_RED)
+            transceiver.set_property('fec-percentage', FEC_PERCENTAGE)
+
+    def attach(self, name, connect_signals, receive=()):
+        """Add a webrtcbin fed from every tee; returns it and its branches.
+
+        Given media kinds to receive, the webrtcbin is instead fed from no
+        tee and gets a receive-only transceiver for each of them.
+        connect_signals(webrtc) is called before anything is linked, so
+        no signal can be missed.
+        """
+        # A detached webrtcbin lingers until its branches are idle, so
+        # never reuse a name.
+        self.attached += 1
+        name = '%s-%d' % (name, self.attached)
+        print('Attaching session %s...' % name)
+        webrtc = Gst.ElementFactory.make('webrtcbin', name)
+        if 'latency' in self.profile:
+            webrtc.set_property('latency', self.profile['latency'])
+        connect_signals(webrtc)
+        self.pipe.add(webrtc)
+        if receive:
+            GstWebRTC = import_gi('GstWebRTC')
+            for media in receive:
+                self.configure_transceiver(webrtc.emit(
+                        'add-transceiver',
+                        GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY,
+                        Gst.Caps.from_string(RELAY_CAPS[media])), media)
+        branches = []
+        self.valves[webrtc] = []
+        for media, tee in ({} if receive else self.tees).items():
+            q = Gst.ElementFactory.make('queue')
+            self.configure_queue(q, False)
+            self.pipe.add(q)
+            self.configure_transceiver(self.hold(q, webrtc), media)
+            branches.append((tee, q))
+        if self.layer_tees and not receive:
+            self.attach_layers(webrtc, branches)
+        for tee, q in branches:
+            q.get_static_pad('src').add_probe(
+                    Gst.PadProbeType.EVENT_UPSTREAM, self.on_keyframe_request,
+                    tee)
+        webrtc.sync_state_with_parent()
+        # Created before the first offer, so it includes them.
+        self.channels[webrtc] = [
+                channel for channel in (
+                    webrtc.emit('create-data-channel', label,
+                                Gst.Structure.new_from_string(options))
+                    for label, options in self.args.dataChannel or [])
+                if channel is not None]
+        for valve in self.valves[webrtc]:
+            valve.sync_state_with_parent()
+        for tee, q in branches:
+            q.sync_state_with_parent()
+        branches = [(tee, tee.get_request_pad('src_%u'), q)
+                    for tee, q in branches]
+        for tee, teepad, q in branches:
+            teepad.link(q.get_static_pad('sink'))
+        return webrtc, branches
+
+    def hold(self, element, webrtc):
+        """Link element to webrtc through a closed valve; returns the
+        transceiver of the new sink pad.
+
+        webrtcbin holds data on its sink pads until it is negotiated,
+        which would fill a branch's queue and stall the tee feeding every
+        session; until open() the valve drops the data instead. Only
+        sticky events go through, so the caps still reach webrtcbin for
+        its offer.
+        """
+        valve = Gst.ElementFactory.make('valve')
+        valve.set_property('drop', True)
+        if valve.find_property('drop-mode') is not None:
+            Gst.util_set_object_arg(valve, 'drop-mode',
+                                    'forward-sticky-events')
+        self.pipe.add(valve)
+        element.link(valve)
+        valve.link(webrtc)
+        self.valves[webrtc].append(valve)
+        return (valve.get_static_pad('src').get_peer()
+                .get_property('transceiver'))
+
+    def open(self, webrtc):
+        """Let media through to webrtc, which has been negotiated,
+        starting with a keyframe."""
+        valves = [valve for valve in self.valves.get(webrtc, [])
+                  if valve.get_property('drop')]
+        if not valves:
+            return
+        for valve in valves:
+            valve.set_property('drop', False)
+        selector = self.selectors.get(webrtc)
+        if selector is not None:
+            selector.select(selector.layer)
+        else:
+            self.request_keyframe()
+
+    def attach_layers(self, webrtc, branches):
+        """Feed webrtc one of the --layers encodings, switchable later.
+
+        Every session payloads the encoding it is sent itself, so a
+        switch keeps its SSRC, sequence numbers and timestamps running.
+        """
+        selector = Gst.ElementFactory.make('input-selector')
+        selector.set_property('sync-streams', False)
+        pay = Gst.parse_bin_from_description(
+                '%s ! application/x-rtp,media=video,encoding-name=%s,'
+                'payload=97' % (self.codec['pay'], self.codec['encoding']),
+                True)
+        self.pipe.add(selector, pay)
+        selector.link(pay)
+        self.configure_transceiver(self.hold(pay, webrtc), 'video')
+        pads = []
+        for tee in self.layer_tees:
+            q = Gst.ElementFactory.make('queue')
+            self.configure_queue(q, False)
+            self.pipe.add(q)
+            q.link(selector)
+            pads.append(q.get_static_pad('src').get_peer())
+            branches.append((tee, q))
+        # Start on the best layer the initial bitrate allows.
+        layer = next((i for i, (_, _, kbps) in enumerate(self.args.layers)
+                      if kbps <= self.args.startBitrate),
+                     len(self.args.layers) - 1)
+        selector.set_property('active-pad', pads[layer])
+        pay.sync_state_with_parent()
+        selector.sync_state_with_parent()
+        self.selectors[webrtc] = LayerSelector(self, selector, pay, pads,
+                                               layer)
+        return self.selectors[webrtc]
+
+    def relay_from(self, pad, kind):
+        """Feed a stream received by the relay source to the tees.
+
+        The RTP is depayloaded and payloaded again, so the viewers get
+        the payload type and SSRC they negotiated, but it is never
+        decoded. Keyframe requests from the viewers travel upstream
+        through here, and the source's webrtcbin turns them into PLIs.
+        """
+        encoding = RELAY_CAPS[kind].split('encoding-name=')[1].split(',')[0]
+        sinkpad = self.pipe.get_by_name(kind + 'pay').get_static_pad('sink')
+        peer = sinkpad.get_peer()
+        if peer is not None:
+            # The source rejoined; its old stream ends here.
+            peer.unlink(sinkpad)
+        depay = Gst.parse_bin_from_description(
+                'queue ! ' + DEPAYLOADERS[encoding], True)
+        self.pipe.add(depay)
+        depay.get_static_pad('src').link(sinkpad)
+        depay.sync_state_with_parent()
+        pad.link(depay.get_static_pad('sink'))
+        if kind == 'video':
+            # Viewers already attached wait for it; the source's next
+            # keyframe of its own may be seconds away.
+            self.request_keyframe(self.tees[kind])
+        return depay
+
+    def detach(self, webrtc, branches, elements):
+        """Unlink a session from the tees, then drop its elements.
+
+        The tee pads are unlinked from idle probes so no buffer is in
+        flight; the elements are removed from the asyncio loop once
+        every branch is unlinked.
+        """
+        print('Detaching session %s...' % webrtc.get_name())
+        pending = [len(branches)]
+
+        def finish():
+            pending[0] -= 1
+            if pending[0] > 0:
+                return
+            self.channels.pop(webrtc, None)
+            selector = self.selectors.pop(webrtc, None)
+            to_remove = ([webrtc] + [q for _, _, q in branches] + elements
+                         + (selector.elements if selector else [])
+                         + self.valves.pop(webrtc, []))
+            for element in to_remove:
+                element.set_state(Gst.State.NULL)
+                self.pipe.remove(element)
+
+        def unlink(teepad, _, tee, q):
+            teepad.unlink(q.get_static_pad('sink'))
+            tee.release_request_pad(teepad)
+            self.loop.call_soon_threadsafe(finish)
+            return Gst.PadProbeReturn.REMOVE
+
+        if not branches:
+            pending[0] = 1
+            finish()
+        for tee, teepad, q in branches:
+            teepad.add_probe(Gst.PadProbeType.IDLE, unlink, tee, q)
+
+    def finish_recording(self, recorder, pads, done):
+        """End a recording with EOS, then call done() once it is written.
+
+        A muxer writes its index and durations only on EOS, so a session
+        that records is detached after its file is closed.
+        """
+        self.closing[recorder] = done
+        for pad in pads:
+            pad.send_event(Gst.Event.new_eos())
+        self.loop.call_later(RECORD_CLOSE_TIMEOUT,
+                             self.recording_closed, recorder)
+
+    def recording_closed(self, recorder):
+        done = self.closing.pop(recorder, None)
+        if done is not None:
+            done()
+
+    async def wait_recordings(self):
+        while self.closing:
+            await asyncio.sleep(0.05)
+
+
+class LayerSelector:
+    """Which --layers encoding a session is sent.
+
+    A switch takes effect at the next keyframe of the new layer, which
+    is asked for right away; its delta frames are dropped until then, or
+    for KEYFRAME_MIN_INTERVAL + KEYFRAME_WAIT at most.
+    """
+    def __init__(self, media, selector, pay, pads, layer):
+        self.media = media
+        self.selector = selector
+        self.elements = [selector, pay]
+        self.pads = pads
+        self.layer = layer
+        self.waiting = None
+        selector.get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER,
+                                                 self.on_buffer)
+
+    def select(self, layer):
+        self.layer = layer
+        self.selector.set_property('active-pad', self.pads[layer])
+        if self.media.request_keyframe(self.media.layer_tees[layer]):
+            self.waiting = (time.monotonic() + KEYFRAME_MIN_INTERVAL
+                            + KEYFRAME_WAIT)
+        else:
+            self.waiting = None
+
+    def on_buffer(self, pad, info):
+        """Drop delta frames until a keyframe or the deadline in
+        self.waiting."""
+        waiting = self.waiting
+        if waiting is not None:
+            if (info.get_buffer().has_flags(Gst.BufferFlags.DELTA_UNIT)
+                    and time.monotonic() < waiting):
+                return Gst.PadProbeReturn.DROP
+            self.waiting = None
+        return Gst.PadProbeReturn.OK
+
+
+class WarmWebRTC:
+    """A webrtcbin attached and negotiating before any peer shows up.
+
+    Its offer and ICE candidates are kept until a session adopts it,
+    then handed to the session along with everything emitted later, so
+    a connecting peer does not wait for offer creation or ICE gathering.
+    """
+    def __init__(self, media):
+        self.lock = threading.Lock()
+        self.session = None
+        self.offer = None
+        self.candidates = []
+        self.webrtc, self.branches = media.attach('warm',
+                                                  self.connect_signals)
+
+    def connect_signals(self, webrtc):
+        webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
+        webrtc.connect('on-ice-candidate', self.on_ice_candidate)
+        webrtc.connect('on-data-channel', self.on_data_channel)
+        webrtc.connect('pad-added', self.on_incoming_stream)
+
+    def adopt(self, session):
+        with self.lock:
+            self.session = session
+            if self.offer is not None:
+                session.send_sdp_offer(self.offer)
+            for mlineindex, candidate in self.candidates:
+                session.send_ice_candidate_message(self.webrtc, mlineindex,
+                                                   candidate)
+            self.candidates = []
+
+    def on_negotiation_needed(self, element):
+        with self.lock:
+            session = self.session
+        if session is not None:
+            session.on_negotiation_needed(element)
+            return
+        print('Pre-warming %s...' % element.get_name())
+        promise = Gst.Promise.new_with_change_func(self.on_offer_created,
+                                                   element, None)
+        element.emit('create-offer', None, promise)
+
+    def on_offer_created(self, promise, element, _):
+        promise.wait()
+        offer = promise.get_reply().get_value('offer')
+        with self.lock:
+            self.offer = offer
+            if self.session is not None:
+                self.session.send_sdp_offer(offer)
+        promise = Gst.Promise.new()
+        element.emit('set-local-description', offer, promise)
+        promise.interrupt()
+
+    def on_ice_candidate(self, element, mlineindex, candidate):
+        with self.lock:
+            if self.session is None:
+                self.candidates.append((mlineindex, candidate))
+            else:
+                self.session.send_ice_candidate_message(element, mlineindex,
+                                                        candidate)
+
+    def on_data_channel(self, channel):
+        if self.session is not None:
+            self.session.on_data_channel(channel)
+
+    def on_incoming_stream(self, element, pad):
+        if self.session is not None:
+            self.session.on_incoming_stream(element, pad)
+
+
+class BitrateController:
+    """Loss and delay based rate control for the shared video encoder.
+
+    Each session keeps its own estimate, raised while its receiver
+    reports little loss and cut back on heavy loss or a growing round
+    trip time, like the loss-based controller of Google Congestion
+    Control. The encoder follows the weakest receiver.
+    """
+    def __init__(self, args, media):
+        self.args = args
+        self.media = media
+        self.min_bitrate = args.minBitrate * 1000
+        self.max_bitrate = args.maxBitrate * 1000
+        self.bitrate = min(max(args.startBitrate * 1000, self.min_bitrate),
+                           self.max_bitrate)
+        self.estimates = {}
+        self.min_rtt = {}
+        self.level = 0
+        self.pending_level = 0
+        self.pending_count = 0
+        self.pending_layers = {}
+        media.stats_listeners.append(self.on_stats)
+        media.set_video_bitrate(self.bitrate)
+
+    def update_estimate(self, session):
+        types = import_gi('GstWebRTC').WebRTCStatsType
+        reports = find_stats(session.stats, types.REMOTE_INBOUND_RTP, 'video')
+        if not reports:
+            return
+        report = reports[0]
+        estimate = self.estimates.get(session, self.bitrate)
+        loss = report.get('fraction-lost', 0.0)
+        if loss > 1:
+            # Raw RTCP fraction, in 1/256ths.
+            loss /= 256.0
+        rtt = report.get('round-trip-time', 0.0)
+        min_rtt = min(self.min_rtt.get(session, rtt), rtt)
+        self.min_rtt[session] = min_rtt
+        if loss > 0.1:
+            estimate *= 1 - 0.5 * loss
+        elif rtt > min_rtt + 0.1:
+            # Queues are building up somewhere along the path.
+            estimate *= 0.85
+        elif loss < 0.02:
+            estimate *= 1.08
+        estimate = min(max(estimate, self.min_bitrate), self.max_bitrate)
+        self.estimates[session] = estimate
+        if self.args.verbose:
+            print('%s: loss %.1f%%, rtt %.0f ms, estimate %d kbit/s'
+                  % (session.roomName, 100 * loss, 1000 * rtt,
+                     estimate / 1000))
+
+    def on_stats(self):
+        for session in list(self.estimates):
+            if session.webrtc is None:
+                del self.estimates[session]
+                del self.min_rtt[session]
+                self.pending_layers.pop(session, None)
+        for session in self.media.sessions:
+            if session.webrtc is not None:
+                self.update_estimate(session)
+        if not self.estimates:
+            return
+        if self.media.layer_tees:
+            self.select_layers()
+            return
+        bitrate = int(min(self.estimates.values()))
+        if abs(bitrate - self.bitrate) > self.bitrate / 50:
+            self.bitrate = bitrate
+            self.media.set_video_bitrate(bitrate)
+        if self.args.adaptResolution:
+            self.adapt_resolution()
+
+    def select_layers(self):
+        """Send each session the best layer its estimate allows."""
+        layers = self.args.layers
+        for session, estimate in self.estimates.items():
+            selector = self.media.selectors.get(session.webrtc)
+            if selector is None:
+                continue
+            layer = next((i for i, (_, _, kbps) in enumerate(layers)
+                          if kbps * 1000 <= estimate), len(layers) - 1)
+            if layer == selector.layer:
+                self.pending_layers.pop(session, None)
+                continue
+            pending, count = self.pending_layers.get(session, (layer, 0))
+            count = count + 1 if pending == layer else 1
+            # As in adapt_resolution(), a switch costs a keyframe.
+            if count >= 3:
+                width, height, kbps = layers[layer]
+                print('%s: switching to %dx%d layer at %d kbit/s'
+                      % (session.roomName, width, height, kbps))
+                selector.select(layer)
+                self.pending_layers.pop(session, None)
+            else:
+                self.pending_layers[session] = (layer, count)
+
+    def adapt_resolution(self):
+        level = next(i for i, (minimum, _) in enumerate(RESOLUTION_LADDER)
+                     if self.bitrate >= minimum)
+        if level == self.level:
+            self.pending_count = 0
+            return
+        if level != self.pending_level:
+            self.pending_level = level
+            self.pending_count = 0
+        self.pending_count += 1
+        # Only switch after the estimate stayed put for a few intervals;
+        # every switch costs a keyframe.
+        if self.pending_count >= 3:
+            self.level = level
+            self.pending_count = 0
+            caps = RESOLUTION_LADDER[level][1]
+            print('Switching video to %s at %d kbit/s'
+                  % (caps, self.bitrate / 1000))
+            self.media.set_video_caps(caps)
+
+
+# Type and help text of every exported metric.
+METRICS = {
+    'frames_encoded_total': ('counter', 'Video frames encoded'),
+    'encode_time_seconds': ('gauge', 'Mean encode time per video frame'),
+    'frames_decoded_total': ('counter', 'Video frames decoded'),
+    'latency_seconds': ('gauge', 'Latency the pipeline reports'),
+    'queue_level_buffers': ('gauge', 'Buffers waiting in a queue'),
+    'queue_level_seconds': ('gauge', 'Duration of data waiting in a queue'),
+    'ice_connection_state': ('gauge', 'ICE connection state (1 = current)'),
+    'candidate_pair_info': ('gauge', 'Local candidate type in use'),
+    'bytes_sent_total': ('counter', 'RTP bytes sent'),
+    'bytes_received_total': ('counter', 'RTP bytes received'),
+    'bitrate_out_bps': ('gauge', 'RTP bitrate sent'),
+    'bitrate_in_bps': ('gauge', 'RTP bitrate received'),
+    'packets_lost_in_total': ('counter', 'Packets lost on the way to us'),
+    'packets_lost_out_total': ('counter',
+                               'Packets lost on the way to the peer'),
+    'fraction_lost': ('gauge', 'Fraction lost in the last peer report'),
+    'jitter_seconds': ('gauge', 'Jitter of the received stream'),
+    'remote_jitter_seconds': ('gauge', 'Jitter the peer reports'),
+    'round_trip_time_seconds': ('gauge', 'Round trip time to the peer'),
+}
+
+
+class Metrics:
+    """Per-session WebRTC and pipeline statistics.
+
+    A sample is taken after each stats_loop() update. The latest one is
+    served in Prometheus text format over HTTP, and every one can be
+    appended to a JSON-lines file.
+    """
+    def __init__(self, args, media):
+        self.args = args
+        self.media = media
+        self.sample = {}
+        self.previous = {}
+        self.frames_encoded = 0
+        self.encode_time = 0.0
+        self.encode_frames = 0
+        self.json = None
+        if args.metricsJson:
+            self.json = open(args.metricsJson, 'a', buffering=1)
+        # With --layers each layer has its own encoder; their frames add
+        # up, while their input times are kept apart as the layers share
+        # timestamps.
+        encoders = [media.encoder] + [
+                media.pipe.get_by_name('videoenc-%d' % index)
+                for index in range(len(args.layers or []))]
+        for encoder in encoders:
+            if encoder is None:
+                continue
+            started = {}
+            encoder.get_static_pad('sink').add_probe(
+                    Gst.PadProbeType.BUFFER, self.on_encoder_input, started)
+            encoder.get_static_pad('src').add_probe(
+                    Gst.PadProbeType.BUFFER, self.on_encoder_output, started)
+        media.stats_listeners.append(self.on_stats)
+
+    async def start(self):
+        if self.args.metricsPort:
+            await asyncio.start_server(self.serve, self.args.metricsBind,
+                                       self.args.metricsPort)
+            print('Serving metrics on http://%s:%d/metrics'
+                  % (self.args.metricsBind, self.args.metricsPort))
+
+    def on_encoder_input(self, pad, info, started):
+        if len(started) > 100:
+            # The encoder dropped frames; forget them.
+            started.clear()
+        started[info.get_buffer().pts] = time.monotonic()
+        return Gst.PadProbeReturn.OK
+
+    def on_encoder_output(self, pad, info, encode_started):
+        self.frames_encoded += 1
+        started = encode_started.pop(info.get_buffer().pts, None)
+        if started is not None:
+            self.encode_time += time.monotonic() - started
+            self.encode_frames += 1
+        return Gst.PadProbeReturn.OK
+
+    @staticmethod
+    def queue_levels(queues):
+        return {name: {'buffers': q.get_property('current-level-buffers'),
+                       'seconds': q.get_property('current-level-time') / 1e9}
+                for name, q in queues}
+
+    def rtp_sample(self, session, kind, elapsed):
+        stats = session.stats
+        types = import_gi('GstWebRTC').WebRTCStatsType
+        sample = {}
+        for entry in find_stats(stats, types.OUTBOUND_RTP, kind):
+            sample['bytes_sent_total'] = entry.get('bytes-sent', 0)
+        for entry in find_stats(stats, types.INBOUND_RTP, kind):
+            sample['bytes_received_total'] = entry.get('bytes-received', 0)
+            sample['packets_lost_in_total'] = entry.get('packets-lost', 0)
+            sample['jitter_seconds'] = entry.get('jitter', 0.0)
+        for entry in find_stats(stats, types.REMOTE_INBOUND_RTP, kind):
+            loss = entry.get('fraction-lost', 0.0)
+            sample['fraction_lost'] = loss / 256.0 if loss > 1 else loss
+            sample['packets_lost_out_total'] = entry.get('packets-lost', 0)
+            sample['remote_jitter_seconds'] = entry.get('jitter', 0.0)
+            sample['round_trip_time_seconds'] = \
+                entry.get('round-trip-time', 0.0)
+        previous = self.previous.get(session, {}).get(kind, {})
+        for counter, rate in (('bytes_sent_total', 'bitrate_out_bps'),
+                              ('bytes_received_total', 'bitrate_in_bps')):
+            if counter in sample and counter in previous and elapsed > 0:
+                sample[rate] = \
+                    8 * (sample[counter] - previous[counter]) / elapsed
+        return sample
+
+    def session_sample(self, session, elapsed):
+        stats = session.stats
+        types = import_gi('GstWebRTC').WebRTCStatsType
+        sample = {
+            'ice_connection_state':
+                session.webrtc.get_property('ice-connection-state')
+                .value_nick,
+            'frames_decoded_total': session.frames_decoded,
+            'queues': self.queue_levels(
+                [(tee.get_name().replace('tee', '', 1), q)
+                 for tee, _, q in session.branches]),
+        }
+        pairs = find_stats(stats, types.CANDIDATE_PAIR)
+        for transport in find_stats(stats, types.TRANSPORT):
+            selected = transport.get('selected-candidate-pair-id')
+            if selected in stats:
+                pairs = [stats[selected]]
+        if pairs:
+            local = stats.get(pairs[0].get('local-candidate-id'), {})
+            if 'candidate-type' in local:
+                sample['candidate_type'] = local['candidate-type']
+        for kind in ('audio', 'video'):
+            sample[kind] = self.rtp_sample(session, kind, elapsed)
+        return sample
+
+    def on_stats(self):
+        now = time.time()
+        elapsed = now - self.sample.get('time', now)
+        encode_time = (self.encode_time / self.encode_frames
+                       if self.encode_frames else 0.0)
+        self.encode_time = 0.0
+        self.encode_frames = 0
+        sample = {
+            'time': now,
+            'pipeline': {
+                'frames_encoded_total': self.frames_encoded,
+                'encode_time_seconds': encode_time,
+                'latency_seconds': (self.media.latency or 0) / 1e9,
+                'queues': self.queue_levels(
+                    [(q.get_name(), q) for q in self.media.queues]),
+            },
+            'sessions': {},
+        }
+        previous = {}
+        for session in self.media.sessions:
+            if session.webrtc is None:
+                continue
+            session_sample = self.session_sample(session, elapsed)
+            sample['sessions'][session.roomName] = session_sample
+            previous[session] = session_sample
+        self.sample = sample
+        self.previous = previous
+        if self.json is not None:
+            self.json.write(json.dumps(sample) + '\n')
+
+    def format_prometheus(self):
+        values = {name: [] for name in METRICS}
+
+        def add(name, labels, value):
+            labels = ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                              for k, v in labels.items())
+            values[name].append('minimal_webrtc_%s{%s} %s'
+                                % (name, labels, value))
+
+        def add_queues(labels, queues):
+            for name, level in queues.items():
+                add('queue_level_buffers', dict(labels, queue=name),
+                    level['buffers'])
+                add('queue_level_seconds', dict(labels, queue=name),
+                    level['seconds'])
+
+        pipeline = self.sample.get('pipeline', {})
+        for name, value in pipeline.items():
+            if name != 'queues':
+                add(name, {}, value)
+        add_queues({}, pipeline.get('queues', {}))
+        for room, session in self.sample.get('sessions', {}).items():
+            labels = {'session': room}
+            add('ice_connection_state',
+                dict(labels, state=session['ice_connection_state']), 1)
+            if 'candidate_type' in session:
+                add('candidate_pair_info',
+                    dict(labels, type=session['candidate_type']), 1)
+            add('frames_decoded_total', labels,
+                session['frames_decoded_total'])
+            add_queues(labels, session['queues'])
+            for kind in ('audio', 'video'):
+                for name, value in session[kind].items():
+                    add(name, dict(labels, kind=kind), value)
+        lines = []
+        for name, (kind, text) in METRICS.items():
+            if values[name]:
+                lines.append('# HELP minimal_webrtc_%s %s' % (name, text))
+                lines.append('# TYPE minimal_webrtc_%s %s' % (name, kind))
+                lines.extend(values[name])
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, reader, writer):
+        request = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.split()
+        path = parts[1].decode().split('?')[0] if len(parts) > 1 else ''
+        if path in ('/', '/metrics'):
+            status = '200 OK'
+            body = self.format_prometheus().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+        writer.write(('HTTP/1.0 %s\r\n'
+                      'Content-Type: text/plain; version=0.0.4\r\n'
+                      'Content-Length: %d\r\n\r\n'
+                      % (status, len(body))).encode() + body)
+        await writer.drain()
+        writer.close()
+
+
+# --profile: the GStreamer tracer timing each element (GStreamer 1.18+),
+# the file its records are logged to in the --profile directory, and
+# seconds between samples of queue levels and new records.
+PROFILE_TRACERS = 'latency(flags=pipeline+element)'
+PROFILE_LOG = 'tracer.log'
+PROFILE_INTERVAL = 1.0
+
+
+def enable_tracers(directory):
+    """Have Gst.init() start the --profile tracers, logging to directory."""
+    os.makedirs(directory, exist_ok=True)
+    os.environ['GST_TRACERS'] = ';'.join(
+            filter(None, [os.environ.get('GST_TRACERS'), PROFILE_TRACERS]))
+    os.environ['GST_DEBUG'] = ','.join(
+            filter(None, [os.environ.get('GST_DEBUG'), 'GST_TRACER:7']))
+    os.environ['GST_DEBUG_FILE'] = os.path.join(directory, PROFILE_LOG)
+    os.environ['GST_DEBUG_NO_COLOR'] = '1'
+
+
+def caps_size(pad):
+    caps = pad.get_current_caps()
+    if caps is None or not caps.get_size():
+        return ''
+    s = caps.get_structure(0)
+    found_width, width = s.get_int('width')
+    found_height, height = s.get_int('height')
+    return '%dx%d' % (width, height) if found_width and found_height else ''
+
+
+class Profiler:
+    """Where the pipeline spends its time, per element.
+
+    The latency tracer's records are read back from its log; without it
+    (before GStreamer 1.18) pad probes time each buffer through every
+    element with one sink and one source pad. Either way processing time
+    is kept per element and input resolution, and queue levels are
+    sampled. report() prints the ranking and writes a graph of the
+    pipeline; it runs on exit and on SIGUSR1.
+    """
+    def __init__(self, args, media):
+        self.args = args
+        self.media = media
+        self.started = time.monotonic()
+        # (element, resolution) -> [buffers, total ns, max ns]
+        self.elements = {}
+        # (source, sink) -> [buffers, total ns, max ns]
+        self.latencies = {}
+        # queue -> [samples, total buffers, max buffers, max ns]
+        self.queues = {}
+        self.dumps = 0
+        self.log = None
+        self.partial = ''
+        registry = Gst.Registry.get()
+        if Gst.version() >= (1, 18) and registry.find_feature(
+                'latency', Gst.TracerFactory.__gtype__) is not None:
+            self.method = 'latency tracer'
+            path = os.path.join(args.profile, PROFILE_LOG)
+            if os.path.exists(path):
+                self.log = open(path)
+        else:
+            self.method = 'pad probes'
+            for element in media.pipe.iterate_recurse():
+                self.watch(element)
+            media.pipe.connect('deep-element-added',
+                               lambda _, __, element: self.watch(element))
+        media.loop.add_signal_handler(signal.SIGUSR1, self.report)
+        asyncio.ensure_future(self.run())
+
+    @staticmethod
+    def add(table, key, duration):
+        entry = table.setdefault(key, [0, 0, 0])
+        entry[0] += 1
+        entry[1] += duration
+        entry[2] = max(entry[2], duration)
+
+    def watch(self, element):
+        if isinstance(element, Gst.Bin):
+            return
+        sinks = list(element.iterate_sink_pads())
+        srcs = list(element.iterate_src_pads())
+        if len(sinks) != 1 or len(srcs) != 1:
+            return
+        name = element.get_name()
+        entered = {}
+        sinks[0].add_probe(Gst.PadProbeType.BUFFER, self.on_enter, entered)
+        srcs[0].add_probe(Gst.PadProbeType.BUFFER, self.on_leave, name,
+                          sinks[0], entered)
+
+    def on_enter(self, pad, info, entered):
+        pts = info.get_buffer().pts
+        if pts != Gst.CLOCK_TIME_NONE:
+            if len(entered) > 100:
+                # Buffers the element dropped or retimed.
+                entered.clear()
+            entered[pts] = time.monotonic_ns()
+        return Gst.PadProbeReturn.OK
+
+    def on_leave(self, pad, info, name, sink, entered):
+        started = entered.pop(info.get_buffer().pts, None)
+        if started is not None:
+            self.add(self.elements, (name, caps_size(sink)),
+                     time.monotonic_ns() - started)
+        return Gst.PadProbeReturn.OK
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PROFILE_INTERVAL)
+            self.sample()
+
+    def sample(self):
+        for q in self.media.pipe.iterate_recurse():
+            factory = q.get_factory()
+            if factory is None or factory.get_name() != 'queue':
+                continue
+            entry = self.queues.setdefault(q.get_name(), [0, 0, 0, 0])
+            buffers = q.get_property('current-level-buffers')
+            entry[0] += 1
+            entry[1] += buffers
+            entry[2] = max(entry[2], buffers)
+            entry[3] = max(entry[3], q.get_property('current-level-time'))
+        self.read_log()
+
+    def read_log(self):
+        if self.log is None:
+            return
+        lines = (self.partial + self.log.read()).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            start = line.find('element-latency, ')
+            if start < 0:
+                start = line.find('latency, ')
+            if start < 0:
+                continue
+            record = Gst.Structure.new_from_string(line[start:])
+            if record is None:
+                continue
+            if record.get_name() == 'element-latency':
+                name = record.get_string('element')
+                element = self.media.pipe.get_by_name(name)
+                pad = element and element.get_static_pad('sink')
+                self.add(self.elements, (name, pad and caps_size(pad) or ''),
+                         record.get_uint64('time')[1])
+            else:
+                self.add(self.latencies, (record.get_string('src-element'),
+                                          record.get_string('sink-element')),
+                         record.get_uint64('time')[1])
+
+    def dump_graph(self):
+        self.dumps += 1
+        path = os.path.join(self.args.profile,
+                            'pipeline-%03d.dot' % self.dumps)
+        with open(path, 'w') as f:
+            f.write(Gst.debug_bin_to_dot_data(self.media.pipe,
+                                              Gst.DebugGraphDetails.ALL))
+        return path
+
+    def report(self):
+        self.sample()
+        total = sum(entry[1] for entry in self.elements.values()) or 1
+        print('Profile of %.1f s from %s, slowest elements first:'
+              % (time.monotonic() - self.started, self.method))
+        print('  %-24s %-10s %8s %8s %8s %9s %6s'
+              % ('element', 'input', 'buffers', 'mean ms', 'max ms',
+                 'total ms', 'share'))
+        for (name, size), (count, spent, longest) in sorted(
+                self.elements.items(), key=lambda item: -item[1][1]):
+            print('  %-24s %-10s %8d %8.2f %8.2f %9.1f %5.1f%%'
+                  % (name, size or '-', count, spent / count / 1e6,
+                     longest / 1e6, spent / 1e6, 100.0 * spent / total))
+        if self.latencies:
+            print('Pipeline latency:')
+            for (src, sink), (count, spent, longest) in sorted(
+                    self.latencies.items()):
+                print('  %s -> %s: mean %.2f ms, max %.2f ms over %d buffers'
+                      % (src, sink, spent / count / 1e6, longest / 1e6,
+                         count))
+        if self.queues:
+            print('Queue levels:')
+            print('  %-24s %12s %12s %8s'
+                  % ('queue', 'mean buffers', 'max buffers', 'max ms'))
+            for name, (samples, buffers, most, longest) in sorted(
+                    self.queues.items(), key=lambda item: -item[1][1]):
+                print('  %-24s %12.1f %12d %8.1f'
+                      % (name, buffers / samples, most, longest / 1e6))
+        print('Pipeline graph written to %s' % self.dump_graph())
+
+
+# --receiveVideoTo/--receiveAudioTo modes handing frames to FrameReceiver
+# or shmsink.
+FRAME_MODES = ('numpy', 'shm')
+# Elements turning received RTP into encoded frames (as webmmux and
+# matroskamux take them), by RTP encoding-name.
+DEPAYLOADERS = {
+    'VP8': 'rtpvp8depay',
+    'VP9': 'rtpvp9depay',
+    'OPUS': 'rtpopusdepay',
+    'H264': 'rtph264depay ! h264parse',
+}
+# Seconds to wait for the rest of a peer's streams before recording the
+# ones that arrived, and for a recording to be written out on teardown.
+RECORD_WAIT = 2.0
+RECORD_CLOSE_TIMEOUT = 5.0
+# Where --client sends received media unless told otherwise.
+CLIENT_SINK = 'launch=fakesink sync=true'
+# Seconds before the first attempt to reconnect to the signaling server,
+# doubled after each failed one up to the maximum.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
+# Data channels: bytes per piece of a chunked message (what every SCTP
+# stack takes in one message), buffered bytes at which send() waits and
+# at which it resumes, and the largest chunked message reassembled.
+DATA_CHUNK_SIZE = 16 * 1024
+DATA_HIGH_WATER = 1024 * 1024
+DATA_LOW_WATER = 256 * 1024
+DATA_MAX_MESSAGE = 64 * 1024 * 1024
+AUDIO_DTYPES = {'S16LE': 'int16', 'S32LE': 'int32', 'F32LE': 'float32',
+                'F64LE': 'float64', 'U8': 'uint8', 'S8': 'int8'}
+
+
+class Frame:
+    """A decoded buffer mapped for reading, seen as NumPy arrays.
+
+    The arrays point straight into the buffer's memory, so they are only
+    valid until release(); copy them to keep them longer. Video frames
+    have one 2D array of rows per plane in planes; packed formats also
+    get array, shaped (height, width, bytes per pixel). Audio frames
+    have array shaped (samples, channels).
+    """
+    def __init__(self, sample, kind):
+        import numpy
+        self.buffer = sample.get_buffer()
+        self.caps = sample.get_caps()
+        self.pts = self.buffer.pts
+        self.array = None
+        self.planes = []
+        ok, self.map_info = self.buffer.map(Gst.MapFlags.READ)
+        if not ok:
+            raise RuntimeError('Could not map buffer')
+        data = self.map_info.data
+        if kind == 'audio':
+            s = self.caps.get_structure(0)
+            dtype = AUDIO_DTYPES.get(s.get_value('format'), 'int16')
+            self.array = numpy.frombuffer(data, dtype).reshape(
+                    -1, s.get_value('channels'))
+            return
+        GstVideo = import_gi('GstVideo')
+        info = GstVideo.VideoInfo.new_from_caps(self.caps)
+        n_planes = info.finfo.n_planes
+        for i in range(n_planes):
+            end = info.offset[i + 1] if i + 1 < n_planes else info.size
+            rows = (end - info.offset[i]) // info.stride[i]
+            self.planes.append(numpy.ndarray(
+                    (rows, info.stride[i]), numpy.uint8, data,
+                    info.offset[i]))
+        if n_planes == 1:
+            pixel_stride = info.finfo.pixel_stride[0]
+            self.array = numpy.ndarray(
+                    (info.height, info.width, pixel_stride), numpy.uint8,
+                    data, info.offset[0], (info.stride[0], pixel_stride, 1))
+
+    def release(self):
+        self.array = None
+        self.planes = []
+        if self.map_info is not None:
+            self.buffer.unmap(self.map_info)
+            self.map_info = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FrameReceiver:
+    """Hands decoded frames from an appsink to Python without copying.
+
+    With a callback, it is called with each Frame on the streaming
+    thread. Otherwise iterate over the receiver; each Frame is released
+    when the next one is requested. Either way the appsink and the leaky
+    queue in front of it drop the oldest frames when the consumer falls
+    behind.
+    """
+    def __init__(self, sink, kind, callback=None):
+        self.sink = sink
+        self.kind = kind
+        self.callback = callback
+        if callback is not None:
+            sink.set_property('emit-signals', True)
+            sink.connect('new-sample', self.on_new_sample)
+
+    def on_new_sample(self, sink):
+        sample = sink.emit('pull-sample')
+        if sample is not None:
+            with Frame(sample, self.kind) as frame:
+                self.callback(frame)
+        return Gst.FlowReturn.OK
+
+    def __iter__(self):
+        while True:
+            sample = self.sink.emit('try-pull-sample', Gst.SECOND)
+            if sample is None:
+                if self.sink.get_property('eos'):
+                    return
+                continue
+            with Frame(sample, self.kind) as frame:
+                yield frame
+
+
+def load_callback(target):
+    """Return the function named by "module:function"."""
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    module, _, function = target.partition(':')
+    return getattr(importlib.import_module(module), function)
+
+
+class DataChannel:
+    """One data channel of a session, carrying str and bytes messages.
+
+    Messages arrive on GStreamer's thread and are handed to the asyncio
+    loop, where callback(channel, message) gets each of them. send()
+    waits, without blocking the loop, while more than DATA_HIGH_WATER
+    bytes are buffered in the channel and resumes once it drained to
+    DATA_LOW_WATER. On a channel whose protocol is "chunked", bytes
+    messages travel in pieces of DATA_CHUNK_SIZE bytes, each prefixed
+    with a byte that is 1 if more pieces follow and 0 on the last one;
+    messages sent at the same time go out one after the other, so their
+    pieces never interleave.
+    """
+    def __init__(self, channel, loop, callback=None):
+        self.channel = channel
+        self.loop = loop
+        self.callback = callback
+        self.label = channel.get_property('label')
+        self.chunked = channel.get_property('protocol') == 'chunked'
+        self.waiters = []
+        # Created on the asyncio loop by send(); this may run elsewhere.
+        self.sending = None
+        self.pieces = []
+        self.size = 0
+        states = import_gi('GstWebRTC').WebRTCDataChannelState
+        self.is_open = channel.get_property('ready-state') == states.OPEN
+        self.closed = False
+        channel.set_property('buffered-amount-low-threshold', DATA_LOW_WATER)
+        channel.connect('on-open', self.on_open)
+        channel.connect('on-close', self.on_close)
+        channel.connect('on-buffered-amount-low', self.on_buffered_amount_low)
+        channel.connect('on-message-string', self.on_message)
+        channel.connect('on-message-data', self.on_message_data)
+
+    def on_open(self, _):
+        print('Data channel %s open.' % self.label)
+        self.loop.call_soon_threadsafe(self.set_state, True, False)
+
+    def on_close(self, _):
+        print('Data channel %s closed.' % self.label)
+        self.loop.call_soon_threadsafe(self.set_state, False, True)
+
+    def on_buffered_amount_low(self, _):
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def set_state(self, is_open, closed):
+        self.is_open = is_open
+        self.closed = closed
+        self.wake()
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait_until(self, ready):
+        while not ready():
+            if self.closed:
+                raise ConnectionError('data channel %s is closed'
+                                      % self.label)
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+    def buffered(self):
+        return self.channel.get_property('buffered-amount')
+
+    async def send(self, message):
+        """Send str or bytes once the channel has room for it."""
+        if self.sending is None:
+            self.sending = asyncio.Lock()
+        async with self.sending:
+            await self.send_now(message)
+
+    async def send_now(self, message):
+        await self.wait_until(lambda: self.is_open)
+        if isinstance(message, str):
+            await self.wait_until(lambda: self.buffered() <= DATA_HIGH_WATER)
+            self.channel.emit('send-string', message)
+            return
+        message = memoryview(message)
+        if not self.chunked:
+            await self.wait_until(lambda: self.buffered() <= DATA_HIGH_WATER)
+            self.channel.emit('send-data', GLib.Bytes.new(message.tobytes()))
+            return
+        offset = 0
+        while True:
+            piece = message[offset:offset + DATA_CHUNK_SIZE]
+            offset += DATA_CHUNK_SIZE
+            more = offset < len(message)
+            await self.wait_until(lambda: self.buffered() <= DATA_HIGH_WATER)
+            self.channel.emit('send-data', GLib.Bytes.new(
+                    bytes([more]) + piece.tobytes()))
+            if not more:
+                return
+
+    def on_message(self, _, message):
+        self.loop.call_soon_threadsafe(self.deliver, message)
+
+    def on_message_data(self, _, data):
+        data = data.get_data() or b''
+        if self.chunked:
+            self.loop.call_soon_threadsafe(self.add_piece, data)
+        else:
+            self.loop.call_soon_threadsafe(self.deliver, data)
+
+    def add_piece(self, piece):
+        more = piece[:1] == b'\1'
+        if self.pieces is not None:
+            self.size += len(piece) - 1
+            if self.size > DATA_MAX_MESSAGE:
+                print('Data channel %s: dropping a message over %d bytes'
+                      % (self.label, DATA_MAX_MESSAGE))
+                # Skip the rest of it.
+                self.pieces = None
+            else:
+                self.pieces.append(piece[1:])
+        if not more:
+            pieces, self.pieces, self.size = self.pieces, [], 0
+            if pieces is not None:
+                self.deliver(b''.join(pieces))
+
+    def deliver(self, message):
+        if self.callback is not None:
+            self.callback(self, message)
+        elif isinstance(message, str):
+            print('Data channel %s: %s' % (self.label, message))
+        else:
+            print('Data channel %s: %d bytes' % (self.label, len(message)))
+
+
+def converter(factory):
+    """factory, with as many threads as it can use (gst-launch)."""
+    threads = min(os.cpu_count() or 1, 8)
+    element = Gst.ElementFactory.make(factory)
+    if threads > 1 and element is not None \
+            and element.find_property('n-threads') is not None:
+        return '%s n-threads=%d' % (factory, threads)
+    return factory
+
+
+def ready_caps(element, pad):
+    """The caps element's pad supports in READY, where devices report
+    their formats, or None if unknown."""
+    if element.set_state(Gst.State.READY) == Gst.StateChangeReturn.FAILURE:
+        element.set_state(Gst.State.NULL)
+        return None
+    pad = element.get_static_pad(pad)
+    caps = pad.query_caps(None) if pad is not None else None
+    element.set_state(Gst.State.NULL)
+    if caps is None or caps.is_any() or caps.is_empty():
+        return None
+    return caps
+
+
+def carries_raw(q):
+    """Whether q is fed raw media rather than from an encoder or a
+    payloader."""
+    peer = q.get_static_pad('sink').get_peer()
+    upstream = peer.get_parent_element() if peer is not None else None
+    factory = upstream.get_factory() if upstream is not None else None
+    if factory is None:
+        return True
+    klass = factory.get_metadata('klass') or ''
+    return 'Encoder' not in klass and 'Payloader' not in klass
+
+
+def only_fields(caps, fields):
+    """caps without any field but fields, keeping caps features."""
+    result = Gst.Caps.new_empty()
+    for index in range(caps.get_size()):
+        structure = Gst.Structure.new_empty(
+                caps.get_structure(index).get_name())
+        for field in fields:
+            if caps.get_structure(index).has_field(field):
+                structure.set_value(
+                        field, caps.get_structure(index).get_value(field))
+        result.append_structure_full(structure,
+                                     caps.get_features(index).copy())
+    return result.simplify()
+
+
+def describe_caps(caps):
+    s = caps.get_structure(0)
+    parts = [s.get_string('format') or s.get_name()]
+    found_width, width = s.get_int('width')
+    found_height, height = s.get_int('height')
+    if found_width and found_height:
+        parts.append('%dx%d' % (width, height))
+    found_rate, rate = s.get_int('rate')
+    if found_rate:
+        parts.append('%d Hz' % rate)
+    return ' '.join(parts)
+
+
+def receive_sink(kind, spec, args, profile):
+    """The gst-launch description --receiveVideoTo/--receiveAudioTo asks
+    for, and its mode: "numpy", "shm" or None.
+
+    The element received media ends in is named "sink".
+    """
+    mode, _, target = spec.partition('=')
+    if mode == 'launch':
+        return target, None
+    if mode in FRAME_MODES:
+        # Unless --frameFormat asks for a conversion, frames stay in the
+        # decoder's format and are never copied on the way.
+        description = ('queue leaky=downstream max-size-buffers=%d '
+                       'max-size-bytes=0 max-size-time=0' % args.frameQueue)
+        if kind == 'video' and args.frameFormat:
+            description += (' ! %s ! video/x-raw,format=%s'
+                            % (converter('videoconvert'), args.frameFormat))
+        if mode == 'shm':
+            description += (' ! shmsink name=sink socket-path="%s" '
+                            'wait-for-connection=false sync=false' % target)
+        else:
+            description += (' ! appsink name=sink max-buffers=%d drop=true '
+                            'sync=false' % args.frameQueue)
+        return description, mode
+    if kind == 'video' and spec == 'auto':
+        return ('queue ! %s ! autovideosink name=sink'
+                % converter('videoconvert')), None
+    if kind == 'video':
+        # The decoders of WebRTC's codecs output I420; a device that takes
+        # it gets it as it is, others get YUY2, which every reader takes.
+        sink = Gst.ElementFactory.make('v4l2sink')
+        sink.set_property('device', spec)
+        caps = ready_caps(sink, 'sink')
+        form = 'I420' if caps is not None and caps.can_intersect(
+                Gst.Caps.from_string('video/x-raw,format=I420')) else 'YUY2'
+        return ('queue ! %s ! video/x-raw,format=%s ! '
+                'v4l2sink name=sink device="%s"'
+                % (converter('videoconvert'), form, spec)), None
+    description = 'queue ! audioconvert ! audioresample ! '
+    if spec == 'auto':
+        return description + 'autoaudiosink name=sink', None
+    if mode == 'device':
+        return description + 'pulsesink name=sink device="%s"' % target, None
+    return (description + 'audio/x-raw,format=S16LE,channels=1 ! '
+            'filesink name=sink location="%s" sync=%s'
+            % (spec, str(profile.get('sync', True)).lower())), None
+
+
+class SinkTemplate:
+    """A receive branch, parsed from its description ahead of need.
+
+    One bin is always built and waiting, so an incoming stream only has
+    to add, link and start it; the next one is built on the asyncio loop
+    after it is taken.
+    """
+    def __init__(self, kind, spec, description, mode, loop, prepare=None):
+        self.kind = kind
+        self.spec = spec
+        self.description = description
+        self.mode = mode
+        self.loop = loop
+        self.prepare = prepare
+        self.callback = None
+        if mode == 'numpy' and spec.partition('=')[2]:
+            self.callback = load_callback(spec.partition('=')[2])
+        self.lock = threading.Lock()
+        # Built right away, so a bad spec fails at startup.
+        self.spare = self.build()
+
+    def build(self):
+        branch = Gst.parse_bin_from_description(self.description, True)
+        if self.prepare is not None:
+            self.prepare(branch, self.kind)
+        return branch
+
+    def take(self):
+        with self.lock:
+            branch, self.spare = self.spare, None
+        self.loop.call_soon_threadsafe(self.refill)
+        return branch or self.build()
+
+    def refill(self):
+        with self.lock:
+            if self.spare is not None:
+                return
+        branch = self.build()
+        with self.lock:
+            if self.spare is None:
+                self.spare = branch
+
+
+class WebRTCClient:
+    def __init__(self, args, media, roomName=None, relay_source=False):
+        self.conn = None
+        self.event_loop = None
+        self.outbox = None
+        self.sender = None
+        self.unsent = None
+        self.reconnecting = False
+        self.sent = 0
+        self.send_delay_total = 0.0
+        self.send_delay_max = 0.0
+        self.media = media
+        self.pipe = None
+        self.webrtc = None
+        self.branches = []
+        self.elements = []
+        self.stats = {}
+        self.frames_decoded = 0
+        self.first_frame = None
+        self.frame_receivers = {}
+        self.streams = {}
+        self.channels = {}
+        self.data_callback = None
+        if args.dataCallback:
+            self.data_callback = load_callback(args.dataCallback)
+        self.expected_streams = 0
+        self.recorder = None
+        self.recording_pending = []
+        self.recorded_pads = []
+        self.recordings = 0
+        self.relay_source = relay_source
+        self.url = args.url
+        self.has_offer = False
+        # As a client, join the room as the phone would: answer the
+        # host's offer instead of making one.
+        self.is_host = not args.client
+        self.args = args
+        # Set by connect() to websockets' exceptions; a websocket
+        # stand-in passed to use_connection() does not raise any.
+        self.connection_closed = ()
+        self.connect_errors = ()
+        media.sessions.append(self)
+
+        if roomName is None:
+            # From https://stackoverflow.com/a/2030081
+            self.roomName = ''.join(random.choice(string.ascii_lowercase)
+                                    for i in range(6))
+        else:
+            self.roomName = roomName
+        self.client_url = '#'.join([self.url, self.roomName])
+        print(self.client_url)
+        self.server = 'ws' + self.url[4:] + 'ws/'\
+            + ('host' if self.is_host else 'client') + '/'\
+            + self.roomName + '/'
+
+    def print_qr(self):
+        import qrcode
+        qr = qrcode.QRCode()
+        qr.add_data(self.client_url)
+        qr.print_ascii(tty=sys.stdout.isatty())
 
     async def connect(self):
-        sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
-        self.conn = await websockets.connect(self.server, ssl=sslctx)
-        if not self.is_host:
+        import websockets
+        self.connection_closed = (websockets.ConnectionClosed,)
+        self.connect_errors = (OSError, websockets.WebSocketException)
+        self.reconnecting = not self.args.noReconnect
+        loop = asyncio.get_event_loop()
+        qr = None
+        if self.args.sessions <= 1 and not self.args.noQR and self.is_host:
+            # Render the QR code while the websocket connects.
+            qr = loop.run_in_executor(None, self.print_qr)
+        conn = await self.open_connection()
+        if qr is not None:
+            await qr
+        await self.use_connection(conn)
+
+    async def open_connection(self):
+        import websockets
+        sslctx = None
+        if self.server.startswith('wss:'):
+            sslctx = ssl.create_default_context(
+                    purpose=ssl.Purpose.CLIENT_AUTH)
+        return await websockets.connect(self.server, ssl=sslctx)
+
+    async def reconnect(self):
+        """Connect to the same room again after the websocket closed.
+
+        The webrtcbin and everything feeding it keep running meanwhile.
+        Returns False if the host is stopping instead.
+        """
+        delay = RECONNECT_DELAY
+        while self.reconnecting and not self.media.stopping:
+            print('Signaling for room %s lost; reconnecting in %.1f s...'
+                  % (self.roomName, delay))
+            await asyncio.sleep(delay)
+            try:
+                conn = await self.open_connection()
+            except self.connect_errors as e:
+                print('Reconnecting failed: %s' % e)
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+                continue
+            await self.use_connection(conn)
+            print('Reconnected to room %s.' % self.roomName)
+            self.restart_ice_if_needed(reconnected=True)
+            return True
+        return False
+
+    async def use_connection(self, conn):
+        """Signal over conn, an open websocket or anything that quacks
+        like one (send(), close() and async iteration)."""
+        self.conn = conn
+        self.event_loop = asyncio.get_event_loop()
+        if self.outbox is None:
+            # Kept across reconnects; what was not sent goes out then.
+            self.outbox = asyncio.Queue()
+        self.sender = asyncio.ensure_future(self.send_loop())
+        if not self.is_host and self.webrtc is None:
             await self.conn.send('{"ready": "separateIce"}')
             self.start_pipeline()
 
+    def send_message(self, msg):
+        """Queue msg for the websocket; safe to call from any thread.
+
+        The websocket belongs to the asyncio loop, so GStreamer's threads
+        only hand messages over and return; send_loop() writes them out
+        in the order they were queued.
+        """
+        self.event_loop.call_soon_threadsafe(
+                self.outbox.put_nowait, (time.monotonic(), msg))
+
+    async def send_loop(self):
+        while True:
+            if self.unsent is None:
+                self.unsent = await self.outbox.get()
+            queued, msg = self.unsent
+            try:
+                await self.conn.send(msg)
+            except self.connection_closed:
+                # Kept in self.unsent for the next connection.
+                return
+            self.unsent = None
+            delay = time.monotonic() - queued
+            self.sent += 1
+            self.send_delay_total += delay
+            self.send_delay_max = max(self.send_delay_max, delay)
+
     def send_sdp_offer(self, offer):
         if not self.is_host and not self.has_offer:
             pass
         text = offer.sdp.as_text()
         print('Sending offer:\n%s' % text)
         msg = json.dumps({'description': {'type': 'offer', 'sdp': text}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(msg))
+        self.send_message(msg)
 
     def on_offer_created(self, promise, _, __):
         print('In on_offer_created...')
         promise.wait()
         reply = promise.get_reply()
         offer = reply.get_value('offer')
+        # Queue the offer before setting it locally so it goes out ahead
+        # of the ICE candidates that setting it starts gathering.
+        self.send_sdp_offer(offer)
         promise = Gst.Promise.new()
         self.webrtc.emit('set-local-description', offer, promise)
         promise.interrupt()
-        self.send_sdp_offer(offer)
 
     def on_negotiation_needed(self, element):
         print('In on_negotiation_needed...')
+        if not self.is_host:
+            # The host makes the offers.
+            return
         promise = Gst.Promise.new_with_change_func(self.on_offer_created,
                                                    element, None)
         element.emit('create-offer', None, promise)
 
+    def on_ice_connection_state(self, element, _):
+        if element is self.webrtc:
+            self.event_loop.call_soon_threadsafe(self.restart_ice_if_needed)
+
+    def restart_ice_if_needed(self, reconnected=False):
+        """Renegotiate with new ICE credentials if connectivity was lost.
+
+        Only a failed ICE connection needs it while signaling is up; after
+        a reconnect a disconnected one is restarted too, as its
+        candidates may have changed meanwhile.
+        """
+        if self.webrtc is None or not self.has_offer or not self.is_host:
+            return
+        states = import_gi('GstWebRTC').WebRTCICEConnectionState
+        state = self.webrtc.get_property('ice-connection-state')
+        if state == states.FAILED or (reconnected
+                                      and state == states.DISCONNECTED):
+            print('ICE connection %s; restarting ICE.' % state.value_nick)
+            promise = Gst.Promise.new_with_change_func(self.on_offer_created,
+                                                       self.webrtc, None)
+            self.webrtc.emit('create-offer', Gst.Structure.new_from_string(
+                    'offer-options, ice-restart=(boolean)true'), promise)
+
+    def on_offer_set(self, promise, element, _):
+        promise = Gst.Promise.new_with_change_func(self.on_answer_created,
+                                                   element, None)
+        element.emit('create-answer', None, promise)
+
+    def on_answer_created(self, promise, element, _):
+        print('In on_answer_created...')
+        promise.wait()
+        answer = promise.get_reply().get_value('answer')
+        text = answer.sdp.as_text()
+        print('Sending answer:\n%s' % text)
+        self.send_message(json.dumps({'description': {'type': 'answer',
+                                                      'sdp': text}}))
+        promise = Gst.Promise.new()
+        element.emit('set-local-description', answer, promise)
+        promise.interrupt()
+
+    def apply_settings(self, settings):
+        """As the client, send only the media the host asked for."""
+        GstWebRTC = import_gi('GstWebRTC')
+        wanted = {
+            'video': settings.get('client-video') not in (None, False,
+                                                          'none', 'false'),
+            'audio': bool(settings.get('client-audio')),
+        }
+        index = 0
+        while True:
+            transceiver = self.webrtc.emit('get-transceiver', index)
+            if transceiver is None:
+                break
+            index += 1
+            kind = transceiver.get_property('kind').value_nick
+            if not wanted.get(kind, True):
+                transceiver.set_property(
+                        'direction',
+                        GstWebRTC.WebRTCRTPTransceiverDirection.RECVONLY)
+
     def send_ice_candidate_message(self, _, mlineindex, candidate):
         if not self.is_host and not self.has_offer:
             pass
         icemsg = json.dumps({'candidate': candidate,
                              'sdpMLineIndex': mlineindex})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(icemsg))
+        self.send_message(icemsg)
 
     def on_incoming_decodebin_stream(self, _, pad):
         print('In on_incoming_decodebin_stream...')
@@ -140,121 +2224,299 @@ class WebRTCClient:
 
         caps = pad.get_current_caps()
         assert caps.get_size()
-        s = caps.get_structure(0)
-        name = s.get_name()
-        if name.startswith('video'):
-            print("Connecting incoming video stream...")
-            q = Gst.ElementFactory.make('queue')
-            conv = Gst.ElementFactory.make('videoconvert')
-            if self.args.receiveVideoTo == 'auto':
-                print('Displaying video to screen using autovideosink.')
-                sink = Gst.ElementFactory.make('autovideosink')
-                self.pipe.add(q)
-                self.pipe.add(conv)
-                self.pipe.add(sink)
-                self.pipe.sync_children_states()
-                pad.link(q.get_static_pad('sink'))
-                q.link(conv)
-                conv.link(sink)
-            else:
-                print('Sending video to v4l2 device %s.'
-                      % self.args.receiveVideoTo)
-                caps = Gst.Caps.from_string("video/x-raw,format=YUY2")
-                capsfilter = Gst.ElementFactory.make("capsfilter", "vfilter")
-                capsfilter.set_property("caps", caps)
-                sink = Gst.ElementFactory.make('v4l2sink')
-                sink.set_property('device', self.args.receiveVideoTo)
-                self.pipe.add(q)
-                self.pipe.add(conv)
-                self.pipe.add(capsfilter)
-                self.pipe.add(sink)
-                self.pipe.sync_children_states()
-                pad.link(q.get_static_pad('sink'))
-                q.link(conv)
-                conv.link(capsfilter)
-                capsfilter.link(sink)
-        elif name.startswith('audio'):
-            print("Connecting incoming audio stream...")
-            q = Gst.ElementFactory.make('queue')
-            conv = Gst.ElementFactory.make('audioconvert')
-            resample = Gst.ElementFactory.make('audioresample')
-            if self.args.receiveAudioTo == 'auto':
-                print('Playing audio using autoaudiosink.')
-                sink = Gst.ElementFactory.make('autoaudiosink')
-                self.pipe.add(q, conv, resample, sink)
-                self.pipe.sync_children_states()
-                pad.link(q.get_static_pad('sink'))
-                q.link(conv)
-                conv.link(resample)
-                resample.link(sink)
-            elif self.args.receiveAudioTo.startswith('device='):
-                device = self.args.receiveAudioTo[len('device='):]
-                print('Playing audio using pulseaudio device %s.' % device)
-                sink = Gst.ElementFactory.make('pulsesink')
-                sink.set_property('device', device)
-                self.pipe.add(q, conv, resample, sink)
-                self.pipe.sync_children_states()
-                pad.link(q.get_static_pad('sink'))
-                q.link(conv)
-                conv.link(resample)
-                resample.link(sink)
-            else:
-                print('Sending audio to file %s.' % self.args.receiveAudioTo)
-                caps = Gst.Caps.from_string(
-                        "audio/x-raw,format=S16LE,channels=1")
-                capsfilter = Gst.ElementFactory.make("capsfilter", "afilter")
-                capsfilter.set_property("caps", caps)
-                sink = Gst.ElementFactory.make('filesink')
-                sink.set_property('location', self.args.receiveAudioTo)
-                sink.set_property('sync', 'true')
-                self.pipe.add(q)
-                self.pipe.add(conv)
-                self.pipe.add(resample)
-                self.pipe.add(capsfilter)
-                self.pipe.add(sink)
-                self.pipe.sync_children_states()
-                pad.link(q.get_static_pad('sink'))
-                q.link(conv)
-                conv.link(resample)
-                resample.link(capsfilter)
-                capsfilter.link(sink)
+        name = caps.get_structure(0).get_name()
+        kind = name.split('/')[0]
+        template = self.media.sink_templates.get(kind)
+        if template is None:
+            return
+        index = self.streams.get(kind, 0)
+        self.streams[kind] = index + 1
+        print('Connecting incoming %s stream %d to %s...'
+              % (kind, index, template.spec))
+        if kind == 'video':
+            pad.add_probe(Gst.PadProbeType.BUFFER, self.on_decoded_frame)
+        branch = template.take()
+        sink = branch.get_by_name('sink')
+        if index and sink is not None:
+            # Another stream of the same kind; do not share the target.
+            for prop in ('location', 'socket-path'):
+                if sink.find_property(prop) is not None:
+                    base, ext = os.path.splitext(sink.get_property(prop))
+                    sink.set_property(prop, '%s-%d%s' % (base, index, ext))
+        if template.mode == 'numpy':
+            self.frame_receivers.setdefault(kind, []).append(
+                    FrameReceiver(sink, kind, template.callback))
+        elif template.mode == 'shm':
+            sink.get_static_pad('sink').connect(
+                    'notify::caps', self.on_shm_caps,
+                    sink.get_property('socket-path'))
+        self.media.watch_conversions(branch)
+        self.pipe.add(branch)
+        self.elements.append(branch)
+        branch.sync_state_with_parent()
+        pad.link(branch.get_static_pad('sink'))
+
+    def on_shm_caps(self, pad, _, target):
+        caps = pad.get_current_caps()
+        if caps is not None:
+            print('Read them with: shmsrc socket-path=%s ! %s'
+                  % (target, caps.to_string()))
+
+    def on_decoded_frame(self, pad, info):
+        if self.first_frame is None:
+            self.first_frame = time.monotonic()
+        self.frames_decoded += 1
+        return Gst.PadProbeReturn.OK
 
     def on_incoming_stream(self, _, pad):
         print('In on_incoming_stream...')
         if pad.direction != Gst.PadDirection.SRC:
             return
+        if self.relay_source:
+            # The stream's kind is known from its caps, set by the time
+            # the first buffer arrives.
+            pad.add_probe(Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER,
+                          self.on_relayed_stream_blocked, self.webrtc)
+            return
+        if self.args.recordTo:
+            # Hold the first buffer: the muxer needs a pad for every
+            # stream before it writes anything, so the streams are linked
+            # together once they all arrived.
+            pad.add_probe(Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER,
+                          self.on_recorded_stream_blocked, self.webrtc)
+            return
+        self.link_decodebin(pad)
 
+    def link_decodebin(self, pad):
         decodebin = Gst.ElementFactory.make('decodebin')
         decodebin.connect('pad-added', self.on_incoming_decodebin_stream)
+        if self.args.lossRecovery:
+            decodebin.connect('deep-element-added',
+                              lambda _, __, element:
+                              request_keyframes_on_loss(element))
         self.pipe.add(decodebin)
+        self.elements.append(decodebin)
         decodebin.sync_state_with_parent()
-        self.webrtc.link(decodebin)
+        pad.link(decodebin.get_static_pad('sink'))
+
+    def decodes(self, kind):
+        to = self.args.receiveVideoTo if kind == 'video' \
+            else self.args.receiveAudioTo
+        return to not in (None, 'none')
+
+    def on_recorded_stream_blocked(self, pad, info, webrtc):
+        self.event_loop.call_soon_threadsafe(self.add_recorded_stream,
+                                             webrtc, pad, info.id)
+        return Gst.PadProbeReturn.OK
+
+    def add_recorded_stream(self, webrtc, pad, probe):
+        if webrtc is not self.webrtc:
+            return
+        if self.recorder is not None:
+            # The muxer already started; it cannot take another stream.
+            print('Not recording late %s.' % pad.get_name())
+            self.link_unrecorded(pad, self.stream_kind(pad))
+            pad.remove_probe(probe)
+            return
+        self.recording_pending.append((pad, probe))
+        if self.expected_streams \
+                and len(self.recording_pending) >= self.expected_streams:
+            self.start_recording(webrtc)
+        elif len(self.recording_pending) == 1:
+            self.event_loop.call_later(RECORD_WAIT,
+                                       self.start_recording, webrtc)
+
+    def on_relayed_stream_blocked(self, pad, info, webrtc):
+        self.event_loop.call_soon_threadsafe(self.relay_stream,
+                                             webrtc, pad, info.id)
+        return Gst.PadProbeReturn.OK
+
+    def relay_stream(self, webrtc, pad, probe):
+        if webrtc is not self.webrtc:
+            return
+        kind = self.stream_kind(pad)
+        if kind in self.media.tees:
+            print('Relaying %s from room %s.' % (kind, self.roomName))
+            self.elements.append(self.media.relay_from(pad, kind))
+        else:
+            self.link_unrecorded(pad, kind)
+        pad.remove_probe(probe)
 
-    def on_data_channel_open(self):
-        print('In on_data_channel_open...')
+    def stream_kind(self, pad):
+        return pad.get_current_caps().get_structure(0).get_string('media')
 
-    def on_data_channel_message(self, msg):
-        print('In on_data_channel_message...')
-        print('Data channel message: %s' % msg)
+    def link_unrecorded(self, pad, kind):
+        if self.decodes(kind):
+            self.link_decodebin(pad)
+            return
+        sink = Gst.ElementFactory.make('fakesink')
+        sink.set_property('sync', False)
+        self.pipe.add(sink)
+        self.elements.append(sink)
+        sink.sync_state_with_parent()
+        pad.link(sink.get_static_pad('sink'))
+
+    def recording_location(self):
+        base, ext = os.path.splitext(self.args.recordTo)
+        if self.args.sessions > 1:
+            base += '-' + self.roomName
+        if self.recordings:
+            # The peer rejoined; do not overwrite the earlier recording.
+            base += '-%d' % self.recordings
+        if self.args.recordSegment:
+            base += '-%05d'
+        self.recordings += 1
+        return base + ext
+
+    def start_recording(self, webrtc):
+        """Mux the received streams as they are, without decoding them."""
+        if webrtc is not self.webrtc or self.recorder is not None \
+                or not self.recording_pending:
+            return
+        pending, self.recording_pending = self.recording_pending, []
+        location = self.recording_location()
+        muxer = 'webmmux' if location.lower().endswith('.webm') \
+            else 'matroskamux'
+        print('Recording %d stream(s) to %s using %s.'
+              % (len(pending), location, muxer))
+        recorder = Gst.ElementFactory.make('splitmuxsink')
+        recorder.set_property('location', location)
+        recorder.set_property('muxer-factory', muxer)
+        if self.args.recordSegment:
+            recorder.set_property('max-size-time',
+                                  int(self.args.recordSegment * Gst.SECOND))
+            # Have the sender start a new segment with a keyframe.
+            recorder.set_property('send-keyframe-requests', True)
+        self.pipe.add(recorder)
+        self.elements.append(recorder)
+        self.recorder = recorder
+
+        links = []
+        for pad, probe in pending:
+            s = pad.get_current_caps().get_structure(0)
+            kind = s.get_string('media')
+            encoding = (s.get_string('encoding-name') or '').upper()
+            chain = DEPAYLOADERS.get(encoding)
+            muxpad = None
+            if chain is not None:
+                muxpad = recorder.get_request_pad(
+                        'video' if kind == 'video' else 'audio_%u')
+            if muxpad is None:
+                print('Cannot record %s %s stream.' % (encoding, kind))
+                links.append((pad, probe, kind, None))
+                continue
+            depay = Gst.parse_bin_from_description('queue ! ' + chain, True)
+            self.pipe.add(depay)
+            self.elements.append(depay)
+            depay.get_static_pad('src').link(muxpad)
+            target = depay
+            if self.decodes(kind):
+                # Also decode it, from a copy of the RTP stream.
+                tee = Gst.ElementFactory.make('tee')
+                q = Gst.ElementFactory.make('queue')
+                self.pipe.add(tee, q)
+                self.elements.extend([tee, q])
+                tee.link(depay)
+                tee.link(q)
+                self.link_decodebin(q.get_static_pad('src'))
+                q.sync_state_with_parent()
+                tee.sync_state_with_parent()
+                target = tee
+            depay.sync_state_with_parent()
+            links.append((pad, probe, kind, target.get_static_pad('sink')))
+        recorder.sync_state_with_parent()
+
+        for pad, probe, kind, sinkpad in links:
+            if sinkpad is None:
+                self.link_unrecorded(pad, kind)
+            else:
+                pad.link(sinkpad)
+                self.recorded_pads.append(sinkpad)
+            pad.remove_probe(probe)
 
     def on_data_channel(self, channel):
         print('In on_data_channel...')
-        self.data_channel = channel
-        channel.connect('on-open', self.on_data_channel_open)
-        channel.connect('on-message-string', self.on_data_channel_message)
+        self.add_channel(channel)
+
+    def add_channel(self, channel):
+        """Wrap a data channel the peer or the host opened.
+
+        Its signals are connected right away, on whichever thread this
+        runs, so no early message is missed.
+        """
+        channel = DataChannel(channel, self.event_loop, self.data_callback)
+        self.channels[channel.label] = channel
+        return channel
 
     def start_pipeline(self):
         print('In start_pipeline...')
-        self.pipe = Gst.parse_launch(self.pipeline)
-        self.webrtc = self.pipe.get_by_name('sendrecv')
-        self.webrtc.connect('on-negotiation-needed',
-                            self.on_negotiation_needed)
-        self.webrtc.connect('on-ice-candidate',
-                            self.send_ice_candidate_message)
-        self.webrtc.connect('on-data-channel',
-                            self.on_data_channel)
-        self.webrtc.connect('pad-added', self.on_incoming_stream)
-        self.pipe.set_state(Gst.State.PLAYING)
+        if self.webrtc:
+            # The peer rejoined the room; start over with a new webrtcbin.
+            self.stop_pipeline()
+        self.pipe = self.media.pipe
+        warm = None if self.relay_source else self.media.take_warm()
+        if self.relay_source:
+            self.webrtc, self.branches = self.media.attach(
+                    'relay-' + self.roomName, self.connect_signals,
+                    receive=list(self.media.tees))
+        elif warm is not None:
+            print('Using pre-warmed %s.' % warm.webrtc.get_name())
+            self.webrtc, self.branches = warm.webrtc, warm.branches
+            warm.adopt(self)
+        else:
+            self.webrtc, self.branches = self.media.attach(
+                    'sendrecv-' + self.roomName, self.connect_signals)
+        self.webrtc.connect('notify::ice-connection-state',
+                            self.on_ice_connection_state)
+        for channel in self.media.channels.pop(self.webrtc, []):
+            self.add_channel(channel)
+
+    def connect_signals(self, webrtc):
+        webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
+        webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
+        webrtc.connect('on-data-channel', self.on_data_channel)
+        webrtc.connect('pad-added', self.on_incoming_stream)
+
+    def stop_pipeline(self):
+        print('In stop_pipeline...')
+        if self.recorder is not None:
+            self.media.finish_recording(
+                    self.recorder, self.recorded_pads,
+                    functools.partial(self.media.detach, self.webrtc,
+                                      self.branches, self.elements))
+        else:
+            self.media.detach(self.webrtc, self.branches, self.elements)
+        self.webrtc = None
+        self.branches = []
+        self.elements = []
+        self.channels = {}
+        self.streams = {}
+        self.expected_streams = 0
+        self.recorder = None
+        self.recording_pending = []
+        self.recorded_pads = []
+        self.stats = {}
+        self.has_offer = False
+
+    async def update_stats(self, timeout):
+        if self.webrtc is None:
+            return
+        future = self.event_loop.create_future()
+        promise = Gst.Promise.new_with_change_func(self.on_stats, future)
+        self.webrtc.emit('get-stats', None, promise)
+        try:
+            self.stats = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def on_stats(self, promise, future):
+        reply = promise.get_reply()
+        stats = stats_to_dict(reply) if reply is not None else {}
+
+        def done():
+            if not future.done():
+                future.set_result(stats)
+        self.event_loop.call_soon_threadsafe(done)
 
     async def handle_sdp(self, msg):
         if not self.webrtc:
@@ -265,17 +2527,37 @@ class WebRTCClient:
                   % self.webrtc.get_property('connection-state'))
             self.has_offer = True
             sdp = msg['description']
-            assert(sdp['type'] == 'answer')
+            expected = 'answer' if self.is_host else 'offer'
+            assert(sdp['type'] == expected)
             sdp = sdp['sdp']
-            print('Received answer:\n%s' % (sdp))
+            print('Received %s:\n%s' % (expected, sdp))
+            GstSdp = import_gi('GstSdp')
+            GstWebRTC = import_gi('GstWebRTC')
             res, sdpmsg = GstSdp.SDPMessage.new()
             GstSdp.sdp_message_parse_buffer(bytes(sdp.encode()), sdpmsg)
+            # Streams the peer is going to send, for start_recording().
+            medias = [sdpmsg.get_media(i)
+                      for i in range(sdpmsg.medias_len())]
+            self.expected_streams = len([
+                media for media in medias
+                if media.get_media() in ('audio', 'video')
+                and media.get_attribute_val('recvonly') is None
+                and media.get_attribute_val('inactive') is None])
+            if not self.is_host:
+                offer = GstWebRTC.WebRTCSessionDescription.new(
+                        GstWebRTC.WebRTCSDPType.OFFER, sdpmsg)
+                promise = Gst.Promise.new_with_change_func(
+                        self.on_offer_set, self.webrtc, None)
+                self.webrtc.emit('set-remote-description', offer, promise)
+                self.media.open(self.webrtc)
+                return
             answer = GstWebRTC.WebRTCSessionDescription.new(
                        GstWebRTC.WebRTCSDPType.ANSWER,
                        sdpmsg)
             promise = Gst.Promise.new()
             self.webrtc.emit('set-remote-description', answer, promise)
             promise.interrupt()
+            self.media.open(self.webrtc)
         elif 'candidate' in msg:
             candidate = msg['candidate']
             sdpmlineindex = msg['sdpMLineIndex']
@@ -283,27 +2565,95 @@ class WebRTCClient:
 
     async def loop(self):
         assert self.conn
+        while True:
+            try:
+                await self.receive_loop()
+            except self.connection_closed as e:
+                print('Signaling connection closed: %s' % e)
+            self.sender.cancel()
+            if not await self.reconnect():
+                break
+        if self.sent:
+            print('Sent %d signaling messages, queue to wire: '
+                  'avg %.2f ms, max %.2f ms'
+                  % (self.sent, 1000 * self.send_delay_total / self.sent,
+                     1000 * self.send_delay_max))
+        if self.webrtc:
+            self.stop_pipeline()
+        return 0
+
+    async def receive_loop(self):
         async for message in self.conn:
             msg = json.loads(message)
             if 'ready' in msg:
                 self.start_pipeline()
-                await self.conn.send(json.dumps({'settings': {
+                receiveVideo = self.args.receiveVideo
+                receiveAudio = self.args.receiveAudio
+                sendVideo = self.media.sendVideo
+                sendAudio = self.media.sendAudio
+                if self.args.relay:
+                    # The source only sends, its viewers only receive.
+                    if self.relay_source:
+                        sendVideo = sendAudio = False
+                    else:
+                        receiveVideo = receiveAudio = False
+                settings = json.dumps({'settings': {
                     'separateIce': True,
                     'serverless': False,
-                    'client-video': 'none' if self.args.receiveVideo == 'false' else self.args.receiveVideo,
-                    'client-audio': self.args.receiveAudio,
-                    'host-video': self.sendVideo,
-                    'host-audio': self.sendAudio,
+                    'client-video': 'none' if receiveVideo == 'false' else receiveVideo,
+                    'client-audio': receiveAudio,
+                    'host-video': sendVideo,
+                    'host-audio': sendAudio,
                     'debug': True,
-                }}))
+                }})
+                # Queued directly: anything the new webrtcbin hands over via
+                # send_message() only reaches the outbox after we yield.
+                self.outbox.put_nowait((time.monotonic(), settings))
+            elif 'settings' in msg:
+                self.apply_settings(msg['settings'])
             else:
                 await self.handle_sdp(msg)
-        return 0
 
 
-def check_plugins():
-    needed = ["opus", "vpx", "nice", "webrtc", "dtls", "srtp", "rtp",
-              "rtpmanager", "videotestsrc", "audiotestsrc"]
+def request_keyframes_on_loss(element):
+    """Have a depayloader or decoder ask the sender for a keyframe when
+    packets are lost or a frame is corrupt, at most every
+    KEYFRAME_MIN_INTERVAL, and drop frames until it arrives instead of
+    showing them smeared."""
+    settings = {
+        'request-keyframe': True,
+        'wait-for-keyframe': True,
+        'automatic-request-sync-points': True,
+        'min-force-key-unit-interval':
+            int(KEYFRAME_MIN_INTERVAL * Gst.SECOND),
+        'discard-corrupted-frames': True,
+    }
+    for name, value in settings.items():
+        if element.find_property(name) is not None:
+            element.set_property(name, value)
+
+
+def registry_key():
+    """Describe the plugin registry well enough to notice it changing."""
+    paths = [os.environ.get('GST_REGISTRY_1_0')
+             or os.environ.get('GST_REGISTRY')]
+    if not paths[0]:
+        cache = (os.environ.get('XDG_CACHE_HOME')
+                 or os.path.expanduser('~/.cache'))
+        paths = sorted(glob.glob(os.path.join(cache, 'gstreamer-1.0',
+                                              'registry.*.bin')))
+    key = [Gst.version_string(), os.environ.get('GST_PLUGIN_PATH', ''),
+           os.environ.get('GST_PLUGIN_SYSTEM_PATH', '')]
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key.append('%s:%d:%d' % (path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            key.append(path)
+    return '|'.join(key)
+
+
+def check_plugins(needed=NEEDED_PLUGINS):
     missing = list(filter(
                 lambda p: Gst.Registry.get().find_plugin(p) is None, needed))
     if len(missing):
@@ -312,14 +2662,225 @@ def check_plugins():
     return True
 
 
-if __name__ == '__main__':
-    Gst.init(None)
-    if not check_plugins():
-        sys.exit(1)
+def cpu_key():
+    model = ''
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return '%s:%s:%d' % (os.uname().machine, model, os.cpu_count() or 1)
+
+
+def encoder_available(codec):
+    return all(Gst.ElementFactory.find(element.split()[0]) is not None
+               for element in (codec['encoder'], codec['pay']))
+
+
+def benchmark_encoder(codec, width, height, framerate, frames):
+    """Encode test frames as fast as possible.
+
+    Returns the frames per second reached and the CPU seconds spent per
+    frame, or None if the encoder failed.
+    """
+    pipe = Gst.parse_launch(
+            'videotestsrc num-buffers=%d pattern=smpte ! '
+            'video/x-raw,format=I420,width=%d,height=%d,framerate=%d/1 ! '
+            '%s%s ! fakesink sync=false'
+            % (frames, width, height, framerate, codec['encoder'],
+               ' ! ' + codec['caps'] if 'caps' in codec else ''))
+    started = time.monotonic()
+    cpu = time.process_time()
+    pipe.set_state(Gst.State.PLAYING)
+    msg = pipe.get_bus().timed_pop_filtered(
+            60 * Gst.SECOND, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu
+    pipe.set_state(Gst.State.NULL)
+    if msg is None or msg.type != Gst.MessageType.EOS:
+        return None
+    return frames / elapsed, cpu / frames
+
+
+def select_video_codec(args):
+    """Pick the --videoCodec to use, or None if none of them works.
+
+    Of several candidates the one using the least CPU while still
+    encoding faster than --codecTarget wins. The choice is cached for
+    the same plugins, CPU and target.
+    """
+    names = AUTO_CODECS if args.videoCodec == 'auto' else args.videoCodec
+    names = [name.strip() for name in names.split(',')]
+    unknown = [name for name in names if name not in VIDEO_CODECS]
+    if unknown:
+        print('Unknown video codecs:', unknown)
+        return None
+    available = [name for name in names
+                 if encoder_available(VIDEO_CODECS[name])]
+    if not available:
+        print('No encoder available for video codecs:', names)
+        return None
+    if len(available) == 1:
+        return available[0]
+
+    width, height, framerate = [int(v) for v in args.codecTarget
+                                .replace('@', 'x').split('x')]
+    key = '|'.join([registry_key(), cpu_key(), ','.join(available),
+                    args.codecTarget])
+    try:
+        with open(CODEC_CACHE) as f:
+            codec = json.load(f).get(key)
+        if codec in available:
+            return codec
+    except (OSError, ValueError):
+        pass
+    print('Benchmarking video encoders at %s...' % args.codecTarget)
+    results = {}
+    for name in available:
+        results[name] = benchmark_encoder(VIDEO_CODECS[name], width, height,
+                                          framerate, 2 * framerate)
+        if results[name] is None:
+            print('  %-9s failed' % name)
+        else:
+            print('  %-9s %6.0f fps  %6.2f ms CPU per frame'
+                  % (name, results[name][0], 1000 * results[name][1]))
+    working = [name for name in available if results[name] is not None]
+    if not working:
+        return None
+    fast = [name for name in working if results[name][0] >= framerate]
+    codec = min(fast or working, key=lambda name: results[name][1])
+    print('Using %s.' % codec)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(CODEC_CACHE, 'w') as f:
+            json.dump({key: codec}, f)
+    except OSError:
+        pass
+    return codec
+
+
+def parse_layers(spec):
+    layers = []
+    try:
+        for layer in spec.split(','):
+            size, kbps = layer.split('@')
+            width, height = size.split('x')
+            layers.append((int(width), int(height), int(kbps)))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                'expected WIDTHxHEIGHT@KBITS,..., got %r' % spec)
+    return sorted(layers, key=lambda layer: -layer[2])
+
+
+def parse_data_channel(spec):
+    """Turn LABEL[:OPTION...] into a label and create-data-channel options."""
+    label, *flags = spec.split(':')
+    options = {'ordered': 'true'}
+    for flag in flags:
+        name, _, value = flag.partition('=')
+        if flag in ('ordered', 'unordered'):
+            options['ordered'] = 'true' if flag == 'ordered' else 'false'
+        elif name == 'retransmits' and value.isdigit():
+            options['max-retransmits'] = '(int)' + value
+        elif name == 'lifetime' and value.isdigit():
+            options['max-packet-lifetime'] = '(int)' + value
+        elif flag == 'chunked':
+            options['protocol'] = '(string)chunked'
+        else:
+            raise argparse.ArgumentTypeError('unknown data channel option %r'
+                                             % flag)
+    if 'protocol' in options and (options['ordered'] == 'false'
+                                  or 'max-retransmits' in options
+                                  or 'max-packet-lifetime' in options):
+        raise argparse.ArgumentTypeError(
+                'chunked data channels have to be ordered and reliable')
+    options['ordered'] = '(boolean)' + options['ordered']
+    return label, 'options, ' + ', '.join('%s=%s' % option
+                                          for option in options.items())
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--url', help='URL from minimal-webrtc',
                         default='https://localhost/camera/')
     parser.add_argument('--roomName', help='room name to host')
+    parser.add_argument('--client', action='store_true',
+                        help='instead of hosting, join --roomName as the '
+                             + 'phone would: answer the host\'s offer, send '
+                             + '--sendVideo/--sendAudio and receive the '
+                             + 'host\'s media (by default to a fakesink)')
+    parser.add_argument('--noQR', action='store_true',
+                        help='do not print the QR code for the room URL')
+    parser.add_argument('--noReconnect', action='store_true',
+                        help='exit when the signaling connection closes '
+                             + 'instead of reconnecting and keeping the '
+                             + 'call running')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='number of rooms to host at once, all fed '
+                             + 'from a single shared encoder')
+    parser.add_argument('--relay', action='store_true',
+                        help='forward what the peer of the first room sends '
+                             + '(see --receiveVideo/--receiveAudio) to the '
+                             + 'peers of the other --sessions rooms, without '
+                             + 'decoding it')
+    parser.add_argument('--prewarm', type=int, default=0,
+                        help='number of webrtcbins to keep ready, with '
+                             + 'their offer made and ICE gathered, for '
+                             + 'the next peers to connect')
+    parser.add_argument('--layers', type=parse_layers,
+                        help='encode these layers, like '
+                             + '1280x720@2500,640x360@800,320x180@250 '
+                             + '(WIDTHxHEIGHT@KBITS), and send each '
+                             + 'receiver the best its bandwidth allows '
+                             + '(implies --adaptBitrate)')
+    parser.add_argument('--adaptBitrate', action='store_true',
+                        help='adjust the video bitrate to the loss and '
+                             + 'round trip time receivers report')
+    parser.add_argument('--adaptResolution', action='store_true',
+                        help='also lower resolution and framerate at low '
+                             + 'bitrates (implies --adaptBitrate)')
+    parser.add_argument('--minBitrate', type=int, default=150,
+                        help='lowest video bitrate in kbit/s')
+    parser.add_argument('--maxBitrate', type=int, default=2500,
+                        help='highest video bitrate in kbit/s')
+    parser.add_argument('--lossRecovery', choices=['nack', 'fec'],
+                        help='recover from packet loss: negotiate NACK '
+                             + 'and RTX for video, encode it error '
+                             + 'resilient and have decoders ask for a '
+                             + 'keyframe on loss; "fec" also adds ULPFEC '
+                             + 'with RED (default: GStreamer defaults)')
+    parser.add_argument('--startBitrate', type=int, default=800,
+                        help='initial video bitrate in kbit/s')
+    parser.add_argument('--statsInterval', type=float, default=1.0,
+                        help='seconds between webrtcbin statistics updates')
+    parser.add_argument('--metricsPort', type=int,
+                        help='serve Prometheus metrics on this HTTP port')
+    parser.add_argument('--metricsBind', default='127.0.0.1',
+                        help='address to serve metrics on')
+    parser.add_argument('--metricsJson',
+                        help='append a JSON line of metrics to this file '
+                             + 'every --statsInterval seconds')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='time every pipeline element and print the '
+                             + 'slowest ones, queue levels and a pipeline '
+                             + 'graph to DIR on exit and on SIGUSR1')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print statistics as they are gathered')
+    parser.add_argument('--videoCodec', default='auto',
+                        help='video codec to send (%s), or several '
+                             % ', '.join(VIDEO_CODECS)
+                             + 'separated by commas to use the cheapest '
+                             + 'one on this CPU; "auto" is %s' % AUTO_CODECS)
+    parser.add_argument('--codecTarget', default='1280x720@30',
+                        help='WIDTHxHEIGHT@FPS the chosen video codec has '
+                             + 'to keep up with')
+    parser.add_argument('--latencyProfile', choices=list(LATENCY_PROFILES),
+                        help='tune queues, jitterbuffer, encoder and sinks '
+                             + 'for latency or quality (default: GStreamer '
+                             + 'defaults)')
     parser.add_argument('--sendAudio', default='test',
                         help='GStreamer audio pipeline to send')
     parser.add_argument('--sendVideo', default='test',
@@ -332,10 +2893,61 @@ if __name__ == '__main__':
     parser.add_argument('--receiveAudioTo', default=None,
                         help='"auto" or file path or device=DEVICE '
                              + 'where DEVICE is a PulseAudio sink '
-                             + 'to send received audio to ')
+                             + 'to send received audio to, or a frame '
+                             + 'destination or launch=PIPELINE as for '
+                             + '--receiveVideoTo, or '
+                             + '"none" to only record it')
     parser.add_argument('--receiveVideoTo', default=None,
-                        help='"auto" or file path to send received video to')
-    args = parser.parse_args()
+                        help='"auto" or v4l2 device path to send received '
+                             + 'video to, or numpy=MODULE:FUNCTION to call '
+                             + 'FUNCTION with every decoded frame, or '
+                             + 'shm=SOCKET for shmsink, or launch=PIPELINE '
+                             + 'for a gst-launch description, or "none" to '
+                             + 'only record it')
+    parser.add_argument('--dataChannel', action='append',
+                        type=parse_data_channel, metavar='LABEL[:OPTION...]',
+                        help='open a data channel to every peer; OPTIONs '
+                             + 'are ordered (default), unordered, '
+                             + 'retransmits=N, lifetime=MS and chunked (split '
+                             + 'large binary messages); may be repeated')
+    parser.add_argument('--dataCallback', metavar='MODULE:FUNCTION',
+                        help='call FUNCTION(channel, message) with every '
+                             + 'data channel message instead of printing it')
+    parser.add_argument('--recordTo',
+                        help='record received audio and video, without '
+                             + 'decoding them, to this .webm or .mkv file')
+    parser.add_argument('--recordSegment', type=float, default=0,
+                        help='start a new --recordTo file (numbered '
+                             + 'NAME-00000.webm, ...) every this many '
+                             + 'seconds')
+    parser.add_argument('--frameFormat',
+                        help='convert video for numpy=/shm= to this raw '
+                             + 'format (default: keep the decoder\'s)')
+    parser.add_argument('--frameQueue', type=int, default=2,
+                        help='frames numpy=/shm= hold before dropping the '
+                             + 'oldest')
+    args = parser.parse_args(argv)
+    if args.client and not args.roomName:
+        parser.error('--client needs the --roomName of the host to join')
+    if args.client and (args.relay or args.prewarm):
+        parser.error('--client cannot be combined with --relay or '
+                     '--prewarm, which only apply to hosts')
+    if args.relay and args.sessions < 2:
+        parser.error('--relay needs --sessions 2 or more: a source and '
+                     'its viewers')
+    if args.layers and (args.relay or args.adaptResolution):
+        parser.error('--layers cannot be combined with --relay or '
+                     '--adaptResolution')
+    if args.relay and (args.adaptBitrate or args.adaptResolution):
+        parser.error('--relay forwards the source\'s stream as it is and '
+                     'cannot adapt it')
+
+    if args.client:
+        # A headless client takes whatever the host sends.
+        for kind in ('Audio', 'Video'):
+            if getattr(args, 'receive' + kind) is None \
+                    and getattr(args, 'receive%sTo' % kind) is None:
+                setattr(args, 'receive%sTo' % kind, CLIENT_SINK)
 
     # Support only one of receiveAudio/receiveAudioTo or
     #  receiveVideo/receiveVideoTo while setting reasonable defaults.
@@ -346,7 +2958,7 @@ if __name__ == '__main__':
     elif args.receiveAudio is None:
         args.receiveAudio = True
     elif args.receiveAudioTo is None:
-        args.receiveAudioTo = 'auto'
+        args.receiveAudioTo = 'none' if args.recordTo else 'auto'
 
     if args.receiveVideo is not None and args.receiveVideoTo is not None:
         pass
@@ -355,9 +2967,46 @@ if __name__ == '__main__':
     elif args.receiveVideo is None:
         args.receiveVideo = True
     elif args.receiveVideoTo is None:
-        args.receiveVideoTo = 'auto'
+        args.receiveVideoTo = 'none' if args.recordTo else 'auto'
+    return args
+
 
-    c = WebRTCClient(args)
-    asyncio.get_event_loop().run_until_complete(c.connect())
-    res = asyncio.get_event_loop().run_until_complete(c.loop())
-    sys.exit(res)
+if __name__ == '__main__':
+    args = parse_args()
+    if args.profile:
+        enable_tracers(args.profile)
+    Gst.init(None)
+    if not check_plugins(NEEDED_PLUGINS
+                         + (RECORD_PLUGINS if args.recordTo else [])):
+        sys.exit(1)
+    if not args.relay:
+        args.videoCodec = select_video_codec(args)
+        if args.videoCodec is None:
+            sys.exit(1)
+    media = MediaPipeline(args)
+    media.start()
+    if args.adaptBitrate or args.adaptResolution or args.layers:
+        BitrateController(args, media)
+    if args.metricsPort or args.metricsJson:
+        metrics = Metrics(args, media)
+        asyncio.get_event_loop().run_until_complete(metrics.start())
+    if media.stats_listeners:
+        asyncio.ensure_future(media.stats_loop(args.statsInterval))
+    profiler = Profiler(args, media) if args.profile else None
+    if args.sessions <= 1:
+        roomNames = [args.roomName]
+    else:
+        base = args.roomName or ''.join(random.choice(string.ascii_lowercase)
+                                        for i in range(6))
+        roomNames = ['%s-%d' % (base, i) for i in range(args.sessions)]
+    clients = [WebRTCClient(args, media, roomName,
+                            relay_source=args.relay and i == 0)
+               for i, roomName in enumerate(roomNames)]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(*[c.connect() for c in clients]))
+    res = loop.run_until_complete(asyncio.gather(*[c.loop() for c in clients]))
+    loop.run_until_complete(media.wait_recordings())
+    if profiler is not None:
+        profiler.report()
+    media.stop()
+    sys.exit(max(res + [media.status]))
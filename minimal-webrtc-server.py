@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+
+import asyncio
+import json
+import re
+import resource
+import ssl
+import sys
+import time
+import argparse
+
+import websockets
+
+ROOM_PATH = re.compile(r'/ws/(host|client)/([^/]+)/?$')
+MAX_PENDING = 1000
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+class Room:
+    def __init__(self):
+        self.peers = {'host': None, 'client': None}
+        # Messages for a side that is not connected yet.
+        self.pending = {'host': [], 'client': []}
+
+
+class SignalingServer:
+    """Signaling server for minimal-webrtc-host.py and webrtc-recv.py.
+
+    Websockets on .../ws/host/ROOM/ and .../ws/client/ROOM/ speak the
+    minimal-webrtc protocol: everything one side of a room sends is
+    passed to the other side, and held until it connects. Any other path
+    speaks the HELLO/SESSION protocol of the GStreamer webrtc examples.
+    """
+    def __init__(self):
+        self.rooms = {}
+        self.hello_peers = {}
+        self.sessions = {}
+        self.messages = 0
+
+    async def handler(self, ws, path=None):
+        if path is None:
+            path = getattr(ws, 'path', None) or ws.request.path
+        match = ROOM_PATH.search(path.split('?')[0])
+        try:
+            if match:
+                await self.relay_room(ws, match.group(1), match.group(2))
+            else:
+                await self.hello_protocol(ws)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def relay_room(self, ws, role, name):
+        room = self.rooms.setdefault(name, Room())
+        other = 'client' if role == 'host' else 'host'
+        old = room.peers[role]
+        room.peers[role] = ws
+        if old is not None:
+            # The same side rejoined; the newest connection wins.
+            await old.close()
+        pending, room.pending[role] = room.pending[role], []
+        for message in pending:
+            await ws.send(message)
+        try:
+            async for message in ws:
+                self.messages += 1
+                target = room.peers[other]
+                if target is not None:
+                    try:
+                        await target.send(message)
+                        continue
+                    except websockets.ConnectionClosed:
+                        pass
+                if len(room.pending[other]) < MAX_PENDING:
+                    room.pending[other].append(message)
+        finally:
+            if room.peers[role] is ws:
+                room.peers[role] = None
+                # Whatever this side said is stale for its successor.
+                room.pending[other] = []
+            if room.peers == {'host': None, 'client': None}:
+                self.rooms.pop(name, None)
+
+    async def hello_protocol(self, ws):
+        hello = await ws.recv()
+        if not hello.startswith('HELLO '):
+            await ws.close(code=1002, reason='invalid protocol')
+            return
+        uid = hello.split(' ', 1)[1]
+        if not uid or uid in self.hello_peers:
+            await ws.close(code=1002, reason='invalid peer uid')
+            return
+        self.hello_peers[uid] = ws
+        await ws.send('HELLO')
+        try:
+            async for message in ws:
+                self.messages += 1
+                peer = self.sessions.get(uid)
+                if peer is not None:
+                    await self.hello_peers[peer].send(message)
+                elif message.startswith('SESSION '):
+                    callee = message.split(' ', 1)[1]
+                    if callee not in self.hello_peers:
+                        await ws.send('ERROR peer %r not found' % callee)
+                    elif callee in self.sessions:
+                        await ws.send('ERROR peer %r busy' % callee)
+                    else:
+                        self.sessions[uid] = callee
+                        self.sessions[callee] = uid
+                        await ws.send('SESSION_OK')
+                else:
+                    await ws.send('ERROR unknown command %r' % message)
+        finally:
+            del self.hello_peers[uid]
+            peer = self.sessions.pop(uid, None)
+            if peer is not None:
+                self.sessions.pop(peer, None)
+                if peer in self.hello_peers:
+                    await self.hello_peers[peer].close()
+
+
+class LoadTest:
+    """Opens many host/client room pairs and times messages between them."""
+    def __init__(self, args):
+        self.args = args
+        self.url = 'ws' + args.loadUrl[4:]
+        self.sslctx = None
+        if self.url.startswith('wss:'):
+            self.sslctx = ssl.create_default_context()
+            if args.insecure:
+                self.sslctx.check_hostname = False
+                self.sslctx.verify_mode = ssl.CERT_NONE
+        self.setup_times = []
+        self.rtts = []
+        self.messages = 0
+        self.failures = 0
+
+    async def open_room(self, i, semaphore):
+        name = 'load-%d' % i
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                host = await websockets.connect(
+                        self.url + 'ws/host/%s/' % name, ssl=self.sslctx)
+                client = await websockets.connect(
+                        self.url + 'ws/client/%s/' % name, ssl=self.sslctx)
+                await client.send(json.dumps({'ready': 'separateIce'}))
+                json.loads(await host.recv())
+            except (OSError, websockets.WebSocketException) as e:
+                print('Room %s failed: %s' % (name, e))
+                self.failures += 1
+                return None
+            self.messages += 1
+            self.setup_times.append(time.monotonic() - started)
+            return host, client
+
+    async def exchange(self, host, client):
+        for i in range(self.args.loadMessages):
+            sent = time.monotonic()
+            await host.send(json.dumps({'candidate': 'candidate:%d' % i,
+                                        'sdpMLineIndex': 0}))
+            await client.send(await client.recv())
+            await host.recv()
+            self.rtts.append(time.monotonic() - sent)
+            self.messages += 2
+        await host.close()
+        await client.close()
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.loadConcurrency)
+        started = time.monotonic()
+        rooms = await asyncio.gather(*[self.open_room(i, semaphore)
+                                       for i in range(self.args.loadTest)])
+        rooms = [room for room in rooms if room is not None]
+        opened = time.monotonic()
+        await asyncio.gather(*[self.exchange(host, client)
+                               for host, client in rooms])
+        ended = time.monotonic()
+        print('%d rooms open (%d failed) in %.2f s'
+              % (len(rooms), self.failures, opened - started))
+        print('Room setup ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f'
+              % tuple(1000 * v for v in (
+                  percentile(self.setup_times, 50),
+                  percentile(self.setup_times, 90),
+                  percentile(self.setup_times, 99),
+                  max(self.setup_times, default=float('nan')))))
+        print('Round trip ms: p50 %.1f, p90 %.1f, p99 %.1f, max %.1f'
+              % tuple(1000 * v for v in (
+                  percentile(self.rtts, 50),
+                  percentile(self.rtts, 90),
+                  percentile(self.rtts, 99),
+                  max(self.rtts, default=float('nan')))))
+        print('%d messages relayed in %.2f s: %.0f messages/s'
+              % (self.messages, ended - started,
+                 self.messages / (ended - started)))
+        return 1 if self.failures else 0
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def main(args):
+    sslctx = None
+    if args.cert:
+        sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        sslctx.load_cert_chain(args.cert, args.key)
+    server = SignalingServer()
+    if args.loadTest and args.loadUrl:
+        return await LoadTest(args).run()
+    ws_server = await websockets.serve(server.handler, args.bind, args.port,
+                                       ssl=sslctx, max_queue=None)
+    print('Signaling on %s://%s:%d/'
+          % ('https' if sslctx else 'http', args.bind, args.port))
+    if args.loadTest:
+        args.loadUrl = '%s://%s:%d/' % ('https' if sslctx else 'http',
+                                        args.bind, args.port)
+        res = await LoadTest(args).run()
+        ws_server.close()
+        await ws_server.wait_closed()
+        return res
+    await asyncio.Future()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Local signaling server for minimal-webrtc-host.py '
+                        + 'and webrtc-recv.py.')
+    parser.add_argument('--bind', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('--cert', help='TLS certificate (PEM) to serve wss')
+    parser.add_argument('--key', help='TLS private key for --cert')
+    parser.add_argument('--loadTest', type=int, default=0, metavar='ROOMS',
+                        help='instead of serving, open this many rooms '
+                             + 'and measure signaling round trips')
+    parser.add_argument('--loadMessages', type=int, default=20,
+                        help='round trips per room in --loadTest')
+    parser.add_argument('--loadConcurrency', type=int, default=100,
+                        help='rooms being opened at the same time in '
+                             + '--loadTest')
+    parser.add_argument('--loadUrl',
+                        help='server to load test, like the host\'s --url '
+                             + '(default: start one in this process)')
+    parser.add_argument('--insecure', action='store_true',
+                        help='do not verify the --loadUrl certificate')
+    args = parser.parse_args()
+    if args.loadTest:
+        raise_file_limit()
+    try:
+        res = asyncio.get_event_loop().run_until_complete(main(args))
+    except KeyboardInterrupt:
+        res = 0
+    sys.exit(res)
@@ -30,19 +30,79 @@ webrtcbin name=sendrecv
  queue ! application/x-rtp,media=audio,encoding-name=OPUS,payload=96 ! sendrecv.
 '''
 
+# Seconds before the first attempt to reconnect to the signaling server,
+# doubled after each failed one up to the maximum.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+
 class WebRTCClient:
     def __init__(self, id_, peer_id, server):
         self.id_ = id_
         self.conn = None
+        self.event_loop = None
+        self.outbox = None
+        self.sender = None
+        self.unsent = None
+        self.sent = 0
+        self.send_delay_total = 0.0
+        self.send_delay_max = 0.0
         self.pipe = None
+        self.bus = None
+        self.done = None
         self.webrtc = None
         self.peer_id = peer_id
         self.server = server or 'wss://127.0.0.1:8443'
 
     async def connect(self):
-        sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
+        sslctx = None
+        if self.server.startswith('wss:'):
+            sslctx = ssl.create_default_context(purpose=ssl.Purpose.CLIENT_AUTH)
         self.conn = await websockets.connect(self.server, ssl=sslctx)
-        await self.conn.send('HELLO %d' % our_id)
+        if self.event_loop is None:
+            self.event_loop = asyncio.get_event_loop()
+            # Kept across reconnects; what was not sent goes out then.
+            self.outbox = asyncio.Queue()
+            self.done = self.event_loop.create_future()
+        self.sender = asyncio.ensure_future(self.send_loop())
+        await self.conn.send('HELLO %d' % self.id_)
+
+    async def reconnect(self):
+        """Sign in again after the websocket closed, keeping the call.
+
+        Gives up once the pipeline has ended.
+        """
+        delay = RECONNECT_DELAY
+        while not self.done.done():
+            print('Signaling lost; reconnecting in %.1f s...' % delay)
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                return True
+            except (OSError, websockets.WebSocketException) as e:
+                print('Reconnecting failed: %s' % e)
+                delay = min(2 * delay, RECONNECT_MAX_DELAY)
+        return False
+
+    def send_message(self, msg):
+        """Queue msg for the websocket; safe to call from any thread."""
+        self.event_loop.call_soon_threadsafe(
+                self.outbox.put_nowait, (time.monotonic(), msg))
+
+    async def send_loop(self):
+        while True:
+            if self.unsent is None:
+                self.unsent = await self.outbox.get()
+            queued, msg = self.unsent
+            try:
+                await self.conn.send(msg)
+            except websockets.ConnectionClosed:
+                # Kept in self.unsent for the next connection.
+                return
+            self.unsent = None
+            delay = time.monotonic() - queued
+            self.sent += 1
+            self.send_delay_total += delay
+            self.send_delay_max = max(self.send_delay_max, delay)
 
     async def setup_call(self):
         await self.conn.send('SESSION {}'.format(self.peer_id))
@@ -51,26 +111,36 @@ class WebRTCClient:
         text = offer.sdp.as_text()
         print ('Sending offer:\n%s' % text)
         msg = json.dumps({'sdp': {'type': 'offer', 'sdp': text}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(msg))
+        self.send_message(msg)
 
     def on_offer_created(self, promise, _, __):
         promise.wait()
         reply = promise.get_reply()
         offer = reply['offer']
+        # Queue the offer ahead of the candidates it starts gathering.
+        self.send_sdp_offer(offer)
         promise = Gst.Promise.new()
         self.webrtc.emit('set-local-description', offer, promise)
         promise.interrupt()
-        self.send_sdp_offer(offer)
 
     def on_negotiation_needed(self, element):
         promise = Gst.Promise.new_with_change_func(self.on_offer_created, element, None)
         element.emit('create-offer', None, promise)
 
+    def restart_ice_if_needed(self):
+        """Renegotiate with new ICE credentials if connectivity was lost
+        while signaling was down; otherwise the call just goes on."""
+        state = self.webrtc.get_property('ice-connection-state')
+        if state in (GstWebRTC.WebRTCICEConnectionState.FAILED,
+                     GstWebRTC.WebRTCICEConnectionState.DISCONNECTED):
+            print('ICE connection %s; restarting ICE.' % state.value_nick)
+            promise = Gst.Promise.new_with_change_func(self.on_offer_created, self.webrtc, None)
+            self.webrtc.emit('create-offer', Gst.Structure.new_from_string(
+                    'offer-options, ice-restart=(boolean)true'), promise)
+
     def send_ice_candidate_message(self, _, mlineindex, candidate):
         icemsg = json.dumps({'ice': {'candidate': candidate, 'sdpMLineIndex': mlineindex}})
-        loop = asyncio.new_event_loop()
-        loop.run_until_complete(self.conn.send(icemsg))
+        self.send_message(icemsg)
 
     def on_incoming_decodebin_stream(self, _, pad):
         print("In on_incoming_decodebin_stream...")
@@ -136,8 +206,50 @@ class WebRTCClient:
         self.webrtc.connect('on-negotiation-needed', self.on_negotiation_needed)
         self.webrtc.connect('on-ice-candidate', self.send_ice_candidate_message)
         self.webrtc.connect('pad-added', self.on_incoming_stream)
+        # Wait on the bus' file descriptor from the asyncio loop.
+        self.bus = self.pipe.get_bus()
+        self.event_loop.add_reader(self.bus.get_pollfd().fd,
+                                   self.on_bus_readable)
         self.pipe.set_state(Gst.State.PLAYING)
 
+    def stop_pipeline(self):
+        if self.bus is not None:
+            self.event_loop.remove_reader(self.bus.get_pollfd().fd)
+            self.bus = None
+        self.pipe.set_state(Gst.State.NULL)
+
+    def on_bus_readable(self):
+        while self.bus is not None:
+            message = self.bus.pop()
+            if message is None:
+                break
+            self.on_bus_message(message)
+
+    def on_bus_message(self, message):
+        t = message.type
+        if t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            print('Error from %s: %s\n%s'
+                  % (message.src.get_name(), err.message, debug))
+            if not self.done.done():
+                self.done.set_result(1)
+        elif t == Gst.MessageType.WARNING:
+            err, debug = message.parse_warning()
+            print('Warning from %s: %s\n%s'
+                  % (message.src.get_name(), err.message, debug))
+        elif t == Gst.MessageType.EOS:
+            print('End of stream.')
+            if not self.done.done():
+                self.done.set_result(0)
+        elif t == Gst.MessageType.LATENCY:
+            self.pipe.recalculate_latency()
+        elif t == Gst.MessageType.STATE_CHANGED:
+            if message.src == self.pipe:
+                old, new, pending = message.parse_state_changed()
+                print('Pipeline state %s -> %s'
+                      % (Gst.Element.state_get_name(old),
+                         Gst.Element.state_get_name(new)))
+
     async def handle_sdp(self, message):
         assert (self.webrtc)
         msg = json.loads(message)
@@ -159,23 +271,38 @@ class WebRTCClient:
             self.webrtc.emit('add-ice-candidate', sdpmlineindex, candidate)
 
     async def loop(self):
-        try:
-            assert self.conn
-            async for message in self.conn:
-                if message == 'HELLO':
-                    await self.setup_call()
-                elif message == 'SESSION_OK':
-                    self.start_pipeline()
-                elif message.startswith('ERROR'):
-                    print(message)
-                    return 1
-                else:
-                    await self.handle_sdp(message)
-        except Exception:
-            pass
+        assert self.conn
+        while True:
+            try:
+                async for message in self.conn:
+                    if message == 'HELLO':
+                        await self.setup_call()
+                    elif message == 'SESSION_OK' and self.webrtc:
+                        # Signed in again; the call kept running.
+                        self.restart_ice_if_needed()
+                    elif message == 'SESSION_OK':
+                        self.start_pipeline()
+                    elif message.startswith('ERROR'):
+                        print(message)
+                        return 1
+                    else:
+                        await self.handle_sdp(message)
+            except websockets.ConnectionClosed as e:
+                print('Signaling connection closed: %s' % e)
+            self.sender.cancel()
+            if not self.webrtc or not await self.reconnect():
+                break
+        if self.sent:
+            print('Sent %d signaling messages, queue to wire: '
+                  'avg %.2f ms, max %.2f ms'
+                  % (self.sent, 1000 * self.send_delay_total / self.sent,
+                     1000 * self.send_delay_max))
         if self.webrtc:
-            while True:
-                time.sleep(60)
+            # Signaling is over but the call is not; run until the
+            # pipeline ends or fails.
+            res = await self.done
+            self.stop_pipeline()
+            return res
         return 0
 
 
@@ -201,4 +328,4 @@ if __name__=='__main__':
     c = WebRTCClient(our_id, args.peerid, args.server)
     asyncio.get_event_loop().run_until_complete(c.connect())
     res = asyncio.get_event_loop().run_until_complete(c.loop())
-    #sys.exit(res)
+    sys.exit(res)